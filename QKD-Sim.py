@@ -1,5 +1,8 @@
 import random
 import datetime
+import os
+import shutil
+import zlib
 from mosaik.util import connect_randomly, connect_many_to_one
 import mosaik
 from argparse import ArgumentParser
@@ -39,6 +42,7 @@ GRID_FILE = 'data/%s.json' % GRID_NAME
 RESIDENTIAL_AREA = 1
 MIN_NUMBER_OF_HOUSE_PER_RA = 1
 MIN_NUMBER_OF_HOUSE_PER_RA = 37
+CC_SHARDS = 1 #number of ControlCenter processes, each one owning a subset of the houses
 
 '''
  QUANTUM PART
@@ -57,6 +61,26 @@ EVE_SIMULATION = {"type": 1, "probability": EVE_ATTACK_PROBABILITY} #0 = no Eve
 
 SIMULATION_OUTPUT = False
 
+'''
+ OPTIMIZATIONS
+'''
+SEED = 23
+QKD_OPTIONS = {"packed": False, #packed: photons are sent as 2-bit codes (base64) instead of JSON dicts
+               "seed": SEED,    #seed of the per-entity random streams of houses and CC
+               "key_pool_capacity": None, #max secret bits kept per QKD link (None: no limit)
+               "max_rounds": 1, #QKD rounds the sender may merge in one exchange (1: one round per exchange)
+               "coalesce": False, #coalesce: the photons of the next QKD round share the last message of the current one
+               "adaptive_sizing": False, #size each QKD round from the observed yield to get the missing secret in one round
+               "sizing_overshoot": 2.0, #max ratio between the qubits of an adaptive round and the expected need
+               "key_watermark": 0, #secret bits each house tops its key pool up to between messages (0: off)
+               "aes_session_messages": None, #AES session mode: max messages encrypted (AES-GCM) with one QKD key
+               "aes_session_seconds": None, #AES session mode: max age (seconds) of a session key (both None: off)
+               "payload_codec": "text", #encoding of the exchanged values: text, fixed (32-bit fixed point), float32 or varint (delta)
+               "log_levels": {}, #log level by protocol module (BB84, SARG04, KMB09, OTP, AES, or * for all), WARNING by default
+               "log_sample": 1, #keep one in every log_sample messages logged at each QKD round
+               "metrics_format": "json", #simulation output of the CC: json (lines), parquet or hdf5
+               "metrics_interval": 10800} #seconds between two records of the simulation output
+
 '''
  DEMAND RESPONSE
 '''
@@ -65,7 +89,7 @@ DEMAND_FREQUENCY = 60 #in minutes every hour
 def main():
     global NQUBIT
     global PROTOCOL_USED
-    random.seed(23)
+    random.seed(SEED)
     if SIMULATION_OUTPUT == True:
         for i in range(5, 300, 15): #NQUBIT
             for j in range(0,10,2):
@@ -76,6 +100,7 @@ def main():
                 world = mosaik.World(sim_config)
                 create_scenario(world)
                 world.run(until=END)
+                merge_cc_outputs()
 
     else:
         world = mosaik.World(sim_config)
@@ -89,9 +114,11 @@ def create_scenario(world):
     pypower = world.start('PyPower', step_size=15*60)
     hhsim = []
     for i in range(0, RESIDENTIAL_AREA):
-        hhsim.append(world.start('HouseholdSim', N=NQUBIT, protocol=PROTOCOLS[PROTOCOL_USED], Eve=EVE_SIMULATION, drFreq=DEMAND_FREQUENCY))
+        hhsim.append(world.start('HouseholdSim', N=NQUBIT, protocol=PROTOCOLS[PROTOCOL_USED], Eve=EVE_SIMULATION, drFreq=DEMAND_FREQUENCY, options=QKD_OPTIONS))
     pvsim = world.start('CSV', sim_start=START, datafile=PV_DATA)
-    cc = world.start('ControlCenter', step_size=1, N=NQUBIT, protocol=PROTOCOLS[PROTOCOL_USED], Eve=EVE_SIMULATION, simulationNumber=START_REAL_TIME, simulation=SIMULATION_OUTPUT, drFreq=DEMAND_FREQUENCY*60)
+    ccs = []
+    for k in range(0, CC_SHARDS):
+        ccs.append(world.start('ControlCenter', step_size=1, N=NQUBIT, protocol=PROTOCOLS[PROTOCOL_USED], Eve=EVE_SIMULATION, simulationNumber=START_REAL_TIME, simulation=SIMULATION_OUTPUT, drFreq=DEMAND_FREQUENCY*60, options=QKD_OPTIONS, shard=k, shards=CC_SHARDS))
 
     # Instantiate models
     grid = pypower.Grid(gridfile=GRID_FILE).children
@@ -101,14 +128,19 @@ def create_scenario(world):
                                         profile_file=PROFILE_FILE,
                                         grid_name=GRID_NAME).children)
     pvs = pvsim.PV.create(12)
-    controlCenter = cc.CC()
+    controlCenters = [cc.CC() for cc in ccs]
 
     # Connect entities
     for i in range(0, RESIDENTIAL_AREA):
         connect_buildings_to_grid(world, houses[i], grid)
-    # Connect to the Control Center
+    # Connect to the Control Center owning each house
     for i in range(0, RESIDENTIAL_AREA):
-        connect_many_to_one(world, houses[i], controlCenter, ('hhrequest', 'ccresponse'), async_requests=True)
+        shards = [[] for k in range(0, CC_SHARDS)]
+        for house in houses[i]:
+            shards[cc_shard(house)].append(house)
+        for k, shard in enumerate(shards):
+            if shard:
+                connect_many_to_one(world, shard, controlCenters[k], ('hhrequest', 'ccresponse'), 'hhnext', async_requests=True)
     connect_randomly(world, pvs, [e for e in grid if 'node' in e.eid], 'P')
 
     # Database
@@ -165,7 +197,8 @@ def create_scenario(world):
             },
         })
 
-        world.connect(controlCenter, vis_topo, 'ccresponse')
+        for controlCenter in controlCenters:
+            world.connect(controlCenter, vis_topo, 'ccresponse')
         webvis.set_etypes({
             'CC': {
                 'cls': 'cc',
@@ -177,6 +210,42 @@ def create_scenario(world):
             },
         })
 
+def cc_shard(house):
+    """
+    Index of the ControlCenter owning a house, from a stable hash of its id
+    """
+    return zlib.crc32(house.full_id.encode()) % CC_SHARDS
+
+def merge_cc_outputs():
+    """
+    Merges the simulation outputs written by the ControlCenter shards into
+    the output of a single ControlCenter
+    """
+    if SIMULATION_OUTPUT == False or CC_SHARDS <= 1:
+        return
+    base = 'output/' + START_REAL_TIME + '-CC'
+    for k in range(0, CC_SHARDS):
+        shard = base + '-' + str(k)
+        if QKD_OPTIONS["metrics_format"] == 'parquet' and os.path.isdir(shard + '.parquet'):
+            os.makedirs(base + '.parquet', exist_ok=True)
+            for name in os.listdir(shard + '.parquet'):
+                os.replace(os.path.join(shard + '.parquet', name), os.path.join(base + '.parquet', str(k) + '-' + name))
+            os.rmdir(shard + '.parquet')
+        elif QKD_OPTIONS["metrics_format"] == 'hdf5' and os.path.exists(shard + '.h5'):
+            import h5py
+            with h5py.File(shard + '.h5', 'r') as src, h5py.File(base + '.h5', 'a') as dst:
+                rows = src['metrics'][:]
+                if 'metrics' not in dst:
+                    dst.create_dataset('metrics', data=rows, maxshape=(None,), chunks=True)
+                else:
+                    dst['metrics'].resize((len(dst['metrics']) + len(rows),))
+                    dst['metrics'][-len(rows):] = rows
+            os.remove(shard + '.h5')
+        elif os.path.exists(shard + '.json'):
+            with open(shard + '.json') as src, open(base + '.json', 'a+') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(shard + '.json')
+
 def connect_buildings_to_grid(world, houses, grid):
     buses = filter(lambda e: e.type == 'PQBus', grid)
     buses = {b.eid.split('-')[1]: b for b in buses}
@@ -185,26 +254,6 @@ def connect_buildings_to_grid(world, houses, grid):
         node_id = house_data[house]['node_id']
         world.connect(house, buses[node_id], ('P_out', 'P'))
 
-parser = ArgumentParser()
-parser.add_argument("-o", "--output",action='store_true')
-parser.add_argument("-t", "--time",  dest="time",
-                    help="Duration of the simulation")
-parser.add_argument("-n", "--nqubit",  dest="nqubit", type=int,
-                    help="Number of qubit exchanged per second.")
-parser.add_argument("-p", "--protocol",  dest="protocol", type=int,
-                    help='1: {"qkd": "BB84", "crypto": "OTP"},   #OPT cryptosystem using BB84 protocol\
-                                       2: {"qkd": "BB84", "crypto": "AES"},   #AES cryptosystem using BB84 protocol\
-                                       3: {"qkd": "SARG04", "crypto": "OTP"}, #OPT cryptosystem using SARG04 protocol\
-                                       4: {"qkd": "SARG04", "crypto": "AES"}, #AES cryptosystem using SARG04 protocol\
-                                       5: {"qkd": "KMB09", "crypto": "OTP"},  #OTP cryptosystem using KMB09 protocol\
-                                       6: {"qkd": "KMB09", "crypto": "AES"}}  #AES cryptosystem using KMB09 protocol')
-args = parser.parse_args()
-
-if args.protocol is not None:
-    PROTOCOL_USED = args.protocol
-if args.nqubit is not None and args.nqubit > 2:
-    NQUBIT = args.nqubit
-
 parser = ArgumentParser()
 parser.add_argument("-o", "--output", dest="output", action='store_true')
 parser.add_argument("-t", "--time",  dest="time", type=int,
@@ -218,6 +267,36 @@ parser.add_argument("-p", "--protocol",  dest="protocol", type=int,
                                        4: {"qkd": "SARG04", "crypto": "AES"}, #AES cryptosystem using SARG04 protocol\
                                        5: {"qkd": "KMB09", "crypto": "OTP"},  #OTP cryptosystem using KMB09 protocol\
                                        6: {"qkd": "KMB09", "crypto": "AES"}}  #AES cryptosystem using KMB09 protocol')
+parser.add_argument("--packed", dest="packed", action='store_true',
+                    help="Send photons with the compact 2-bit wire format.")
+parser.add_argument("--max-rounds", dest="max_rounds", type=int,
+                    help="Max QKD rounds run in a single exchange to fill the secret stack. "
+                         "Eve is drawn for each round: a detected round is dropped (n2), "
+                         "an undetected one keeps the key she changed (n3), as with single rounds.")
+parser.add_argument("--coalesce", dest="coalesce", action='store_true',
+                    help="Piggyback the next QKD round on the last message of the current one.")
+parser.add_argument("--adaptive", dest="adaptive", action='store_true',
+                    help="Size each QKD round to get the missing secret in one round.")
+parser.add_argument("--overshoot", dest="overshoot", type=float,
+                    help="Max ratio between the qubits of an adaptive round and the expected need.")
+parser.add_argument("--watermark", dest="watermark", type=int,
+                    help="Secret bits each house keeps in its key pool, generated while idle.")
+parser.add_argument("--aes-session-messages", dest="aes_session_messages", type=int,
+                    help="Messages encrypted with one AES session key.")
+parser.add_argument("--aes-session-seconds", dest="aes_session_seconds", type=int,
+                    help="Max age (in seconds) of an AES session key.")
+parser.add_argument("--payload-codec", dest="payload_codec", choices=["text", "fixed", "float32", "varint"],
+                    help="Encoding of the values encrypted by the crypto layer.")
+parser.add_argument("--log-level", dest="log_levels", action='append', metavar="[MODULE=]LEVEL",
+                    help="Log level of a protocol module (e.g. BB84=DEBUG), or of all of them. May be repeated.")
+parser.add_argument("--log-sample", dest="log_sample", type=int,
+                    help="Keep one in every N messages logged at each QKD round.")
+parser.add_argument("--metrics-format", dest="metrics_format", choices=["json", "parquet", "hdf5"],
+                    help="File format of the simulation output (parquet needs pyarrow, hdf5 needs h5py).")
+parser.add_argument("--metrics-interval", dest="metrics_interval", type=int,
+                    help="Seconds between two records of the simulation output.")
+parser.add_argument("--cc-shards", dest="cc_shards", type=int,
+                    help="Number of ControlCenter processes, the houses being split between them.")
 args = parser.parse_args()
 
 if args.protocol is not None:
@@ -228,6 +307,35 @@ if args.output is True:
     SIMULATION_OUTPUT = True
 if args.time is not None and args.time > 0:
     END = args.time * 3600
+if args.packed is True:
+    QKD_OPTIONS["packed"] = True
+if args.max_rounds is not None and args.max_rounds > 0:
+    QKD_OPTIONS["max_rounds"] = args.max_rounds
+if args.coalesce is True:
+    QKD_OPTIONS["coalesce"] = True
+if args.adaptive is True:
+    QKD_OPTIONS["adaptive_sizing"] = True
+if args.overshoot is not None and args.overshoot >= 1:
+    QKD_OPTIONS["sizing_overshoot"] = args.overshoot
+if args.watermark is not None and args.watermark > 0:
+    QKD_OPTIONS["key_watermark"] = args.watermark
+if args.aes_session_messages is not None and args.aes_session_messages > 0:
+    QKD_OPTIONS["aes_session_messages"] = args.aes_session_messages
+if args.aes_session_seconds is not None and args.aes_session_seconds > 0:
+    QKD_OPTIONS["aes_session_seconds"] = args.aes_session_seconds
+if args.payload_codec is not None:
+    QKD_OPTIONS["payload_codec"] = args.payload_codec
+for level in args.log_levels or []:
+    module, _, level = level.rpartition('=')
+    QKD_OPTIONS["log_levels"][module or '*'] = level.upper()
+if args.log_sample is not None and args.log_sample > 0:
+    QKD_OPTIONS["log_sample"] = args.log_sample
+if args.metrics_format is not None:
+    QKD_OPTIONS["metrics_format"] = args.metrics_format
+if args.metrics_interval is not None and args.metrics_interval > 0:
+    QKD_OPTIONS["metrics_interval"] = args.metrics_interval
+if args.cc_shards is not None and args.cc_shards > 0:
+    CC_SHARDS = args.cc_shards
 print(args)
 if __name__ == '__main__':
     main()
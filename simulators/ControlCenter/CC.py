@@ -2,7 +2,10 @@
 Control center simulator
 """
 import mosaik_api
-from utils.communicationLayer import comLayer
+from utils.bank import ProtocolBank
+from utils.randomness import stream
+from utils.log import configure
+from utils.metrics import MetricsSink
 import importlib
 import json
 import logging
@@ -13,7 +16,7 @@ META = {
         'CC': {
             'public': True,
             'params': [],
-            'attrs': ['ccresponse'],
+            'attrs': ['ccresponse', 'hhnext'],
         },
     },
 }
@@ -24,20 +27,36 @@ class CC(mosaik_api.Simulator):
         self.eid = 'CC'
         self.step_size = None
         self.HouseDict = {}
+        self.bank = ProtocolBank()   #Protocols of all the houses, the idle ones are skipped when stepping
         self.N = 10         # Default value
         self.ccresponse = []
+        self.serialized = []  #outputs of each house (by bank index) as JSON
+        self.dirty = set()    #houses whose outputs may have changed since the last get_data
         self.responded = 0
+        self.sink = None    #writer of the simulation outputs
 
-    def init(self, sid, step_size, N, protocol, Eve, simulationNumber = 0, simulation=False, drFreq=3600):
+    def init(self, sid, step_size, N, protocol, Eve, simulationNumber = 0, simulation=False, drFreq=3600, options=None, shard=0, shards=1):
+        """
+        @shard : index of this CC when the houses are shared between shards
+        CC processes, each one writing its own simulation output
+        """
         self.eve = Eve
         self.step_size = step_size
         self.N = N
         self.protocol = importlib.import_module('utils.'+protocol["crypto"])
         self.qkd = protocol["qkd"]
-        self.simulationFile = str(simulationNumber) + '-CC.json'
         self.simulation = simulation
         self.drFreq = drFreq
         self.next_step = self.drFreq
+        self.options = options or {}
+        configure(self.options)
+        #Outputs of every house are recorded every metrics_interval seconds
+        self.metrics_interval = self.options.get('metrics_interval') or 10800
+        self.next_metrics = self.metrics_interval
+        if self.simulation == True:
+            path = 'output/' + str(simulationNumber) + '-CC' + ('-' + str(shard) if shards > 1 else '')
+            self.sink = MetricsSink(path, simulationNumber, N, Eve["probability"],
+                                    self.options.get('metrics_format') or 'json')
         return self.meta
 
     def create(self, num, model):
@@ -47,37 +66,52 @@ class CC(mosaik_api.Simulator):
 
     def step(self, time, input):
         #Compute next hour time after
-        if time > self.next_step:
+        while time >= self.next_step:
             self.next_step += self.drFreq
         wait_until_next_DR = False
-        for key, value in input.items():
-            for key2, value2 in value.items():
-                for key3, value3 in value2.items():
-                    self.check_HouseDictionary(key3, value3)
-                    ret = self.HouseDict[key3]["commLayer"].__doStep__(value3)
-                    if type(ret) is dict:
-                        if 'control' in ret and ret['control'] == -2:
-                            self.responded += 1
-                            if self.responded == len(self.HouseDict): #detect the end of responses
-                                wait_until_next_DR = True
-                                self.responded = 0
-                            val = {self.eid+'.': {key3: {'response': ret}}}
-                            yield self.mosaik.set_data(val)
-                        else:
-                            val = {self.eid+'.': {key3: {'response': ret}}}
-                            yield self.mosaik.set_data(val)
-                    elif ret == -1: #reponse value
-                        self.HouseDict[key3]["commLayer"].__add_message_to_be_send__('0.2')
-                    #Output Simulation part
-                    if time and time % 10800 == 0 and self.simulation == True:
-                        logger.info(self.HouseDict[key3]["protocol"].outputs)
-                        #resetting outputs values
-                        with open('output/'+self.simulationFile, 'a+') as file:
-                            file.write(json.dumps({str(self.N)+'-'+str(self.eve["probability"]): self.HouseDict[key3]["protocol"].outputs})+'\n')
-                            file.flush()
+        received = {}
+        #input is {CC: {attr: {house: data}}}, all the houses are read in one pass
+        for key3, value3 in (item for attrs in input.values() for item in attrs.get('ccresponse', {}).items()):
+            self.check_HouseDictionary(key3, value3)
+            if value3:
+                received[self.bank.index(key3)] = value3
+        #next step of the houses: they may start an exchange then
+        wake = min((t for attrs in input.values() for t in attrs.get('hhnext', {}).values() if t > time),
+                   default=self.next_step)
+        #Run the protocols of the houses with something to do
+        outputs = self.bank.step(received, time)
+        #only the houses that were run may have new outputs
+        self.dirty.update(self.bank.stepped.tolist())
+        responses = {}   #data sent back to each house, pushed with one set_data
+        for key3, house in self.HouseDict.items():
+            ret = outputs[house["index"]]
+            if type(ret) is dict:
+                if 'control' in ret and ret['control'] == -2:
+                    self.responded += 1
+                responses[key3] = {'response': ret}
+            elif ret == -1: #reponse value
+                self.bank.add_message(house["index"], 0.2)
+
+        if responses:
+            yield self.mosaik.set_data({self.eid+'.': responses})
 
+        #Output Simulation part
+        if self.sink is not None and time >= self.next_metrics:
+            self.next_metrics = (time // self.metrics_interval + 1)*self.metrics_interval
+            for key3, house in self.HouseDict.items():
+                logger.info(house["protocol"].outputs)
+                self.sink.add(key3, time, house["protocol"].outputs)
+
+        #detect the end of responses (and of the key top ups of the houses)
+        if self.responded and self.responded >= len(self.HouseDict) and self.bank.idle():
+            wait_until_next_DR = True
+            self.responded = 0
         if wait_until_next_DR == True:
-            return time + (self.next_step - time)
+            return min(self.next_step, wake)
+        elif not received and self.bank.idle():
+            #no exchange running: sleep until the next demand response, or until
+            #the next step of the houses if they may start an exchange earlier
+            return min(self.next_step, wake)
         else:
             return time + self.step_size
 
@@ -89,14 +123,26 @@ class CC(mosaik_api.Simulator):
         if key in self.HouseDict:
           return
         else:
-          protocol = self.protocol.Protocol(self.N, self.eid, False, 0, self.qkd)
-          self.HouseDict[key] = {"commLayer": comLayer(protocol, protocol.__get_states_mapping__()),
-                                 "protocol": protocol}
+          protocol = self.protocol.Protocol(self.N, self.eid, False, 0, self.qkd, self.options,
+                                          stream(self.options.get('seed'), self.eid, key))
+          index = self.bank.add(protocol, key)
+          self.HouseDict[key] = {"commLayer": self.bank.layer(index),
+                                 "protocol": protocol,
+                                 "index": index}
+          self.serialized.append(None)
+          self.dirty.add(index)
+
+    def finalize(self):
+        if self.sink is not None:
+            self.sink.close()
 
     def get_data(self, outputs):
-        self.ccresponse = []
-        for key, val in self.HouseDict.items():
-            self.ccresponse.append(json.dumps(self.HouseDict[key]["protocol"].outputs))
+        #serialize again only the outputs of the houses run since the last call
+        if self.dirty:
+            for index in self.dirty:
+                self.serialized[index] = json.dumps(self.bank.protocol(index).outputs)
+            self.dirty.clear()
+            self.ccresponse = list(self.serialized)
         data = {}
         for eid, attrs in outputs.items():
             data[eid] = {}
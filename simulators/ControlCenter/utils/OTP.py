@@ -1,8 +1,12 @@
-import sys
 import importlib
+from base64 import b64encode, b64decode
+from numpy import frombuffer, bitwise_xor, uint8
+from utils.sizing import RoundSizing
+from utils.keypool import KeyPool
+from utils.payload import codec
+from utils.log import get_logger
 
-INFO = True
-DEBUG = True
+logger = get_logger('OTP')
 
 class Protocol():
     """This class is used to run OTP. It uses a given QKD protocol to
@@ -15,12 +19,14 @@ class Protocol():
     None: nothing to send
     -1: Message received"""
 
-    def __init__(self, N, eid, eve=False, eveP=0, qkd=''):
+    def __init__(self, N, eid, eve=False, eveP=0, qkd='', options=None, rng=None):
         """
         @N : Number of qubit exchanged each second
         @protocol : Protocol of QKD to use.
+        @options : Optional simulation settings shared by every layer (see QKD_OPTIONS)
+        @rng : Random stream of the QKD protocol, derived from eid if None
         """
-        self.protocol = importlib.import_module('utils.'+qkd).Protocol(N, eid, eve, eveP)
+        self.protocol = importlib.import_module('utils.'+qkd).Protocol(N, eid, eve, eveP, options, rng)
         self.isSender = False
         self.eid = eid
         self.N = N
@@ -30,8 +36,26 @@ class Protocol():
         self.sD = []
         #A dictionary of all messages received
         self.rD = []
+        options = options or {}
         #Shared secret stack
-        self.secret = []
+        self.secret = KeyPool(options.get('key_pool_capacity'))
+        #Encoding of the exchanged values into the encrypted payloads
+        self.codec = codec(options.get('payload_codec'))
+        #QKD rounds the sender may run in one exchange to fill the secret stack
+        self.max_rounds = options.get('max_rounds') or 1
+        #Start the next QKD round in the last message of the current one
+        self.coalesce = options.get('coalesce', False)
+        #Size the QKD rounds to get the missing secret in one round
+        self.adaptive = options.get('adaptive_sizing', False)
+        self.sizing = RoundSizing(N, options.get('sizing_overshoot') or 2.0)
+        #Top up the pool to this many bits while there is no traffic
+        self.watermark = options.get('key_watermark') or 0
+        if self.secret.capacity is not None:
+            self.watermark = min(self.watermark, self.secret.capacity)
+        self.refill = False   #start the top ups (set on the side starting the conversations)
+        self.awaiting = False #a response to the last sent message is expected
+        self.target = 0       #pool level aimed at by the running top up
+        self.time = 0         #simulation time (seconds), set by the simulator
         self.outputs = {
             "n1": 0,
             "n2": 0,
@@ -40,6 +64,7 @@ class Protocol():
             "n5": 0,
             'n6': 3600, #Min latency Time (second) per round of message sending
             'n7': 0, #Max latency Time (second) per round of message sending
+            'n8': 0, #Number of secret bits in the key pool
         }
         self.eve = eve
         self.eveP = eveP
@@ -59,58 +84,119 @@ class Protocol():
                  23: self.__send_message__, #Send the message using the shared secret
                  3:  self.__done__ }
 
-    def __debug_print__(self, msg):
-        if DEBUG is True:
-            print('[DEBUG] : ' + msg, file=sys.stdout, flush=True)
+    def __update_outputs__(self, error = 0):
+        rounds = self.protocol.rounds
+        qubits = self.protocol.qubits
+        #Each merged round would have taken the steps of one more QKD round
+        self.elapsed_time += self.protocol.steps*(rounds - 1)
+        self.outputs["n1"] += 3*rounds
+        self.outputs["n4"] += qubits
+        self.outputs["n5"] += (qubits - len(self.protocol.key))
+        #Rounds discarded: the whole exchange, or the rounds intercepted by Eve
+        self.outputs["n2"] += max(error, self.protocol.lost)
+        if not self.target: #top ups are not part of a message latency
+            self.outputs["n6"] = min(self.elapsed_time, self.outputs["n6"])
+            self.outputs["n7"] = max(self.elapsed_time, self.outputs["n7"])
+        self.outputs["n8"] = self.secret.level()
         return
+    def __missing__(self):
+        """
+        Secret bits still needed by the pending message (or by the top up)
+        """
+        return max(self.secret.reserved, self.target) - self.secret.level()
+
+    def __below_watermark__(self):
+        return self.secret.level() < self.watermark
+
+    def __pending__(self):
+        """
+        True if there is something to start when done: a queued message or,
+        when idle, a top up of the pool
+        """
+        return len(self.sD) > 0 or (self.refill and not self.awaiting and self.__below_watermark__())
 
-    def __info_print__(self, msg):
-        if INFO is True:
-            print('[INFO] : ' + msg, file=sys.stdout, flush=True)
+    def __plan_round__(self):
+        """
+        Chooses the qubits of the next QKD exchange started as the sender:
+        one round sized to get the missing secret (adaptive sizing), or as
+        many merged rounds of N qubits as needed up to max_rounds
+        """
+        missing = self.__missing__()
+        rounds, qubits = 1, self.N
+        if self.adaptive:
+            qubits = self.sizing.qubits(missing)
+        elif self.max_rounds > 1:
+            rounds = self.sizing.rounds(missing, self.max_rounds)
+            qubits = self.N*rounds
+        self.protocol.rounds = rounds
+        self.protocol.qubits = qubits
         return
 
-    def __update_outputs__(self, error = 0):
-        self.outputs["n1"] += 3
-        self.outputs["n4"] += self.N
-        self.outputs["n5"] += (self.N - len(self.protocol.key))
-        self.outputs["n2"] += error
-        self.outputs["n6"] = min(self.elapsed_time, self.outputs["n6"])
-        self.outputs["n7"] = max(self.elapsed_time, self.outputs["n7"])
+    def __with_rounds__(self, message):
+        """
+        Tells the receiver how many rounds were merged in the exchange
+        """
+        if self.protocol.rounds > 1:
+            message["rounds"] = self.protocol.rounds
+        return message
+
+    def __receive_round__(self, message, photons):
+        """
+        Starts a QKD round as the receiver of photons, with the number of
+        merged rounds announced in message
+        """
+        self.protocol.rounds = message.get("rounds", 1)
+        return self.__qkd__(photons)
+
+    def __end_round__(self):
+        """
+        Stores the secret of the finished QKD round (or counts its error)
+        """
+        if self.state == 3:
+            self.sizing.observe(self.protocol.qubits, len(self.protocol.key))
+            self.secret.deposit(self.protocol.key)
+            self.__update_outputs__()
+        #If an error occured, we do not store this secret
+        if self.state == 4:
+            self.__update_outputs__(1)
         return
-    def __update_undetected_error__(self, message):
+
+    def __update_undetected_error__(self, payload):
         '''
-        Checks whether the message is a valid float or not.
-        Used for simulation outputs
+        Decodes a received payload and checks whether it is a valid value or not.
+        Returns the value (None if invalid). Used for simulation outputs
         '''
         try:
-            float(message)
-            return
+            #a payload that could not be decrypted is decoded as an empty one
+            #(invalid for every codec), so that stateful codecs stay in step
+            return self.codec.decode(payload if payload is not None else b'')
         except ValueError:
             self.outputs["n3"] += 1
-            return
+            return None
 
     def __add_message__(self, message):
-        self.__info_print__(str(self.eid) + ' add message to be send: ' + message)
-        self.sD.append({"msg": message, "length": len(message)})
+        """
+        Queues a value to be sent, encoded with the payload codec
+        """
+        logger.info('%s add message to be send: %s', self.eid, message)
+        payload = self.codec.encode(message)
+        self.sD.append({"msg": payload, "length": len(payload)})
         return
 
-    def __str_to_bits__(self, text):
-        bits = bin(int.from_bytes(text.encode(), 'big'))[2:]
-        return list(map(int, bits.zfill(8 * ((len(bits) + 7) // 8))))
+    def __Encryption__(self, message, key):
+        """
+        Xors the message bytes with the key bits packed 8 per byte
+        """
+        return bitwise_xor(message, frombuffer(key.tobytes(), dtype=uint8))
 
-    def __str_from_bits__(self, bits):
-        if len(bits) == 1:
-            return bits[0]
-        elif len(bits) == 0:
-            return ''
-        n = int(''.join(map(str, bits)), 2)
-        return n.to_bytes((n.bit_length() + 7) // 8, 'big').decode('latin-1')
+    def __to_wire__(self, data):
+        """
+        Wire format of an encrypted message: its bytes base64 wrapped
+        """
+        return b64encode(data.tobytes()).decode('ascii')
 
-    def __Encryption__(self, message, key):
-        out = []
-        for msg, k in zip(message, key):
-            out.append(int(msg)^int(k))
-        return out
+    def __from_wire__(self, message):
+        return frombuffer(b64decode(message), dtype=uint8)
 
     def __get_message_or_response__(self, data):
         '''
@@ -148,10 +234,10 @@ class Protocol():
         self.state = 0
         self.elapsed_time += 1
         self.rD.append({"msg": '', "length": data['otpl']})
-        if len(self.secret) >= data['otpl']*8:
+        if self.secret.reserve(data['otpl']*8):
             return self.__receive_message__(data)
         else:
-            qkd = self.__qkd__(data['qkd'])
+            qkd = self.__receive_round__(data, data['qkd'])
             return {"otp": "", "qkd": qkd}, 12 #__secret_gen__
 
     def __start_sender__(self, data):
@@ -168,30 +254,41 @@ class Protocol():
         self.isSender = True
         self.state = 0
         self.elapsed_time += 1
-        if len(self.secret) >= len(self.sD[0]['msg'])*8:
+        #The secret is generated for all the queued messages, sent together
+        length = sum(len(msg['msg']) for msg in self.sD)
+        if self.secret.reserve(length*8):
             return self.__send_message__(None) #Send message directly
         else:
+            self.__plan_round__()
             qkd = self.__qkd__(data)
-            return {"otpl": len(self.sD[0]['msg']), "qkd": qkd}, 22 #__qkd_loop__
+            return self.__with_rounds__({"otpl": length, "qkd": qkd}), 22 #__qkd_loop__
 
     def __secret_gen__(self, data):
         self.elapsed_time += 1
-        if self.state == 3:
-            self.secret.extend(self.protocol.key)
-            self.__update_outputs__()
-        #If an error occured, we do not store this secret
-        if self.state == 4:
-            self.__update_outputs__(1)
-        if self.state in [3,4] and len(self.secret)/8 < self.rD[0]["length"]: #end of QKD process
-            if data is None:
-                return {"otp": '', "qkd": ''}, 12 #__secret_gen__
+        self.__end_round__()
+        #0: the last round is stored, the sender did not start the next one yet
+        if self.state in [0,3,4] and self.__missing__() > 0: #end of QKD process
             self.state = 0
-            qkd = self.__qkd__(self.__get_message_or_response__(data)['qkd'])
+            if data is None:
+                return None, 12 #__secret_gen__
+            message = self.__get_message_or_response__(data)
+            qkd = self.__receive_round__(message, message['qkd'])
             return {"otp": '', "qkd": qkd}, 12 #__secret_gen__
 
+        elif self.state > 10 and data is None: #the response of the other side is late
+            return None, 12 #__secret_gen__
         elif self.state > 10: #intermediate states are over 10
-            qkd = self.__qkd__(self.__get_message_or_response__(data)['qkd'])
+            message = self.__get_message_or_response__(data)
+            qkd = self.__qkd__(message['qkd'])
+            if self.state in [3,4] and 'next' in message:
+                #Coalesced message: the sender already started the next round
+                self.__end_round__()
+                self.state = 0
+                qkd = self.__receive_round__(message, message['next'])
             return {"otp": '', "qkd": qkd}, 12 #__secret_gen__
+        elif self.target: #end of the top up
+            self.target = 0
+            return None, 3
         else:
             return None, 13 #__receive_message__
 
@@ -201,60 +298,97 @@ class Protocol():
         Do QKD until the shared secret stack is large enough to perform OTP
         """
         self.elapsed_time += 1
-        if self.state == 3:
-            self.secret.extend(self.protocol.key)
-            self.__update_outputs__()
-        #If an error occured, we do not store this secret
-        if self.state == 4:
-            self.__update_outputs__(1)
-        if self.state in [3,4] and len(self.secret)/8 < len(self.sD[0]['msg']):
+        self.__end_round__()
+        if self.state in [3,4] and self.__missing__() > 0:
             self.state = 0
+            self.__plan_round__()
             qkd = self.__qkd__(None) #to start QKD as sender
-            return {"otp": 1, "qkd": qkd}, 22 #__qkd_loop__
+            return self.__with_rounds__({"otp": 1, "qkd": qkd}), 22 #__qkd_loop__
+        elif self.state > 10 and data is None: #the response of the other side is late
+            return None, 22 #__qkd_loop__
         elif self.state > 10: #intermediate states are over 10
             qkd = self.__qkd__({'response': {self.eid: self.__get_message_or_response__(data)['qkd']}})
+            if self.coalesce and self.state in [3,4]:
+                #End the round now and send the photons of the next one with this message
+                self.__end_round__()
+                self.state = 0 #the round is already stored
+                if self.__missing__() > 0:
+                    self.__plan_round__()
+                    return self.__with_rounds__({"otp": 0, "qkd": qkd, "next": self.__qkd__(None)}), 22 #__qkd_loop__
             return {"otp": 0, "qkd": qkd}, 22 #__qkd_loop__
+        elif self.target: #end of the top up
+            self.target = 0
+            return None, 3
         else:
             return None, 23 #__send_message__
 
     def __send_message__(self, data):
         """
-        Use the shared secret to perform OTP over the message to be sent
-        First convert the message into binary format, then xor it using the secret
+        Use the shared secret to perform OTP over the messages to be sent
+        The payload of each message is xored with the secret packed 8 bits per byte.
+        All the queued messages the secret stack can cover are sent together.
         """
         self.elapsed_time += 1
-        msg = self.sD.pop(0)
-        bits = self.__str_to_bits__(msg['msg'])
-        otp = self.__Encryption__(bits, self.secret)
-        #We need to delete the part of the shared secret stack used
-        self.secret = self.secret[len(bits):]
+        otps = list()
+        while self.sD and (not otps or len(self.sD[0]['msg'])*8 <= self.secret.level()):
+            msg = self.sD.pop(0)
+            data = frombuffer(msg['msg'], dtype=uint8)
+            #The part of the shared secret stack used is deleted
+            otps.append(self.__Encryption__(data, self.secret.consume(8*len(data))))
+        self.outputs["n8"] = self.secret.level()
         self.state = 0
-        #Sending encrypted message
-        return {"otpl": len(otp)/8, "otp": otp, "control": -2}, 3
+        self.awaiting = True
+        #Sending encrypted messages
+        return {"otpl": sum(map(len, otps)), "otp": [self.__to_wire__(otp) for otp in otps], "control": -2}, 3
 
     def __receive_message__(self, data):
         self.elapsed_time += 1
         #If data is None, wait until data is received
         if data is None:
             return None, 13
-        #First decrypt the message
+        #First decrypt the messages, in the order they were encrypted
         data = self.__get_message_or_response__(data)
-        self.rD[0]['msg'] = self.__str_from_bits__(self.__Encryption__(data['otp'], self.secret))
-        #Then delete shared key used
-        self.secret = self.secret[len(data['otp']):]
-        self.__info_print__(str(self.eid) + ' received message: ' + str(self.rD[0]['msg']))
-        #check if it is an undetected error by checking if this message is a valid float
-        self.__update_undetected_error__(self.rD[0]['msg'])
+        for otp in data['otp']:
+            otp = self.__from_wire__(otp)
+            #The shared key used is taken out of the pool
+            payload = self.__Encryption__(otp, self.secret.consume(8*len(otp))).tobytes()
+            #check if it is an undetected error by checking if this payload decodes to a valid value
+            self.rD[0]['msg'] = self.__update_undetected_error__(payload)
+            logger.info('%s received message: %s', self.eid, self.rD[0]['msg'])
+        self.outputs["n8"] = self.secret.level()
         #remove the first received message
         self.rD.pop(0)
         #resetting the Quantum Protocol state
         self.state = 0
+        self.awaiting = False
         return -1, 3 #Message received.
 
+    def __start_refill__(self, data):
+        """
+        Runs QKD rounds to top up the pool to the watermark while idle.
+        @data : None on the side starting the top up, else its first message
+        """
+        self.state = 0
+        if data is None:
+            self.isSender = True
+            self.target = self.watermark
+            self.__plan_round__()
+            qkd = self.__qkd__(None)
+            return self.__with_rounds__({"refill": self.target, "qkd": qkd}), 22 #__qkd_loop__
+        self.isSender = False
+        self.target = data['refill']
+        qkd = self.__receive_round__(data, data['qkd'])
+        return {"otp": "", "qkd": qkd}, 12 #__secret_gen__
+
     def __done__(self, data):
         self.elapsed_time = 0
+        message = self.__get_message_or_response__(data)
+        if message and 'refill' in message: #top up started by the other side
+            return self.__start_refill__(message)
         if data and 'response' in data or data and 'otpl' in data: #restart as a receiver
             return self.__start_receiver__(self.__get_message_or_response__(data))
         elif len(self.sD) >0: #restart as sender
             return self.__start_sender__(None)
+        elif self.__pending__(): #top up the pool while idle
+            return self.__start_refill__(None)
         return None,3
@@ -1,45 +1,43 @@
-from utils.qubit import qubit
-import random
-from numpy import matrix
+from utils.qubit import count_photons, encode_photons, serialize_photons, pack_photons, deserialize_photons, measure_photons, read_states, STATE_PLUS
+from utils.randomness import stream, random_bits
+from utils.bitvector import BitVector
+from numpy import stack, where
 from math import pow, sqrt
-import sys
+from utils.log import get_logger, lazy, key_str
 
-INFO = False
-DEBUG = False
+logger = get_logger('SARG04', rounds=True)
 VERIFICATION = 10
 
 class Protocol():
-    def __init__(self, N, eid, eve=False, eveP=0):
+    def __init__(self, N, eid, eve=False, eveP=0, options=None, rng=None):
         self.eid = eid
         self.N = N                #N is the number of qubit exchanged each QKD round
         self.isSender = True      #Needed to know if the current QKD
                                   #is for receiving or sending information
         self.senderData = {
-            "data": [],           #Received qubit
-            "basis": [],          #Random Basis used by the receiver for a given sender
-            "data2": [],          #Second possibility of qubit
-            "basis2": []          #Basis for the second possibility of qubit
+            "data": BitVector(),           #Received qubit
+            "basis": BitVector(),          #Random Basis used by the receiver for a given sender
+            "data2": BitVector(),          #Second possibility of qubit
+            "basis2": BitVector()          #Basis for the second possibility of qubit
         }
 
         self.receiverData = {
-            "received-qubits": [],  #Received qubit
-            "computed-basis": [],   #Random Basis used by the receiver for a given sender
+            "received-qubits": BitVector(),  #Received qubit
+            "computed-basis": BitVector(),   #Random Basis used by the receiver for a given sender
             "measurements" : []    #qubits measured by the receiver with his random basis
         }
         #Common values :
         self.commonQubits = []
-        self.key = [] #secret shared
+        self.key = BitVector() #secret shared
         self.error = False #Set to true if Eve is present
-        return
-
-    def __debug_print__(self, msg):
-        if DEBUG is True:
-            print('[DEBUG] : ' + msg, file=sys.stdout, flush=True)
-        return
-
-    def __info_print__(self, msg):
-        if INFO is True:
-            print('[INFO] : ' + msg, file=sys.stdout, flush=True)
+        self.rounds = 1    #QKD rounds merged in the current exchange (set by the crypto layer)
+        self.qubits = N    #qubits of the current exchange (set by the sender's crypto layer)
+        self.lost = 0      #merged rounds of the current exchange dropped because of Eve
+        self.steps = 3     #simulation steps of a QKD round
+        options = options or {}
+        self.packed = options.get('packed', False) #Send photons with the compact wire format
+        #Random stream of this entity, seeded from the simulation seed
+        self.rng = rng if rng is not None else stream(options.get('seed'), eid)
         return
 
     def __get_states_mapping__(self):
@@ -66,12 +64,9 @@ class Protocol():
             return self.receiverData
 
     def __generate_random_bits__(self, N):
-        """ This function generates a list of N random bits.
+        """ This function generates a vector of N random bits.
         """
-        aux = list()
-        for i in range(N):
-            aux.append(random.randint(0,1))
-        return aux
+        return BitVector(random_bits(self.rng, N))
 
     def __compute_photons__(self, data, basis):
         """
@@ -79,42 +74,28 @@ class Protocol():
         over the network.
         """
         assert len(data) == len(basis), "Basis and data must be the same length!"
-        message = list()
-        for i in range(len(data)):
-            if not basis[i]:
-                #Base computacional
-                if not data[i]:
-                    message.append(qubit(0).serialize())
-                else:
-                    message.append(qubit(1).serialize())
-            else:
-                #Base Hadamard
-                if not data[i]:
-                    tmp = qubit(0)
-                else:
-                    tmp = qubit(1)
-                tmp.hadamard()
-                message.append(tmp.serialize())
-        return message
+        return self.__serialize__(encode_photons(data, basis))
+
+    def __bits_to_wire__(self, bits):
+        """
+        Puts a vector of bits in the wire format selected for this protocol
+        """
+        if self.packed:
+            return bits.encode()
+        return bits.tolist()
+
+    def __serialize__(self, codes):
+        """
+        Puts state codes in the wire format selected for this protocol
+        """
+        if self.packed:
+            return pack_photons(codes)
+        return serialize_photons(codes)
 
     def __deserialize__(self, data, basis):
-        """This function deserialize a list of serialized qubit into a list
-        of qubit object, and use a basis to change their value accordingly"""
-        out = list()
-        i = 0
-        for value in data:
-            q = qubit(0)
-            #Deserializing qubit...
-            q.state = matrix([[value['state']['0']], [value['state']['1']]])
-            #add basis
-            if not basis[i]:
-                mes = q.measure(0)
-                out.append(mes)
-            else:
-                mes = q.measure(1)
-                out.append(mes)
-            i = i+1
-        return out
+        """This function deserialize a list of serialized qubit and measures
+        all of them at once with the given basis"""
+        return BitVector(measure_photons(deserialize_photons(data), basis, self.rng))
 
     def __IDLE__(self, data=None):
         """
@@ -122,7 +103,7 @@ class Protocol():
         If data is false, QKD will start as the sender of the secret.
         Return next step to do
         """
-        self.key = []
+        self.key = BitVector()
         self.sync = 0
         self.error = False
         if data != None:
@@ -132,96 +113,75 @@ class Protocol():
             return self.__start_sender__(data)
 
     def __start_receiver__(self, data):
-        self.__debug_print__('\x1b[0;33;40m' + 'CC Received Qubits -> ' + str(data) + '\x1b[0m')
+        logger.debug('CC Received Qubits -> %s', data)
         #Compute the random basis to interprete incoming qubits
-        self.receiverData["computed-basis"] = self.__generate_random_bits__(self.N)
-        self.__debug_print__('\x1b[0;33;40m' + 'Computed basis : ' + str(self.receiverData["computed-basis"]) + '\x1b[0m')
+        #The sender chooses the number of qubits of each exchange
+        n = count_photons(data)
+        self.qubits = n
+        self.receiverData["computed-basis"] = self.__generate_random_bits__(n)
+        logger.debug('Computed basis : %s', self.receiverData["computed-basis"])
         #Receive qubits and compute the right result with the previous random basis
         self.receiverData["received-qubits"] = self.__deserialize__(data, self.receiverData["computed-basis"])
-        self.__debug_print__('\x1b[0;33;40m' + 'Measured bits : ' + str(self.receiverData["received-qubits"]) + '\x1b[0m')
-        #Compute the list of qubits measured with the received qubits and the computed basis
-        self.receiverData["measurements"] = self.__compute_photons__(self.receiverData["received-qubits"],self.receiverData["computed-basis"]);
-        self.__debug_print__('\x1b[0;33;40m' + 'Measured photons : ' + str(self.receiverData["measurements"]) + '\x1b[0m')
-        return self.receiverData["computed-basis"], 12
+        logger.debug('Measured bits : %s', self.receiverData["received-qubits"])
+        #Compute the state codes measured with the received qubits and the computed basis
+        self.receiverData["measurements"] = encode_photons(self.receiverData["received-qubits"],self.receiverData["computed-basis"])
+        logger.debug('Measured photons : %s', self.receiverData["measurements"])
+        return self.__bits_to_wire__(self.receiverData["computed-basis"]), 12
 
     def __start_sender__(self, data):
-        self.senderData["data"]  = self.__generate_random_bits__(self.N)
-        self.senderData["basis"] = self.__generate_random_bits__(self.N)
+        self.senderData["data"]  = self.__generate_random_bits__(self.qubits)
+        self.senderData["basis"] = self.__generate_random_bits__(self.qubits)
         ret = self.__compute_photons__(self.senderData["data"], self.senderData["basis"])
-        self.__debug_print__('\x1b[0;31;40m' + str(self.eid) + ' -> CC : ' + str(ret) + '\x1b[0m')
-        self.__debug_print__('\x1b[0;31;40m' + str(self.eid) + ' random key : ' + str(self.senderData["data"]) + '\x1b[0m')
+        logger.debug('%s -> CC : %s', self.eid, ret)
+        logger.debug('%s random key : %s', self.eid, self.senderData["data"])
         #return value to the simulator, and next step value
         return ret, 21
 
+    def __deserialize_pairs__(self, data):
+        """
+        This function turns the packed batch of photons (or the list of
+        serialized qubit couples) into an (N, 2) array of state codes
+        """
+        if isinstance(data, dict):
+            return deserialize_photons(data).reshape(-1, 2)
+        return deserialize_photons([photon for pair in data for photon in pair]).reshape(-1, 2)
+
     def __compare_qbits__(self, measure, value):
         """
-        This function compares the qubit list with the possible qubit couple
-        list and puts a '1' in the validation list if they are different (and
-        an 'x' if not).
+        This function compares the measured state codes with the possible
+        couples of state codes. The validation mask is set where the
+        measurement differs from both of them.
         """
-        validation = list()
-        i = 0
-        for i in range(len(value)):
-            if measure[i] != value[i][0] and measure[i] != value[i][1]:
-                validation.append(1)
-            else:
-                validation.append('x')
-        return validation
+        return BitVector((measure != value[:, 0]) & (measure != value[:, 1]))
 
     def __compute_secret__(self, data, basis, decision):
         """
         This function compute the secret key from the list of qubits
-        possibilities and the decision list according to SARG04 protocol
+        possibilities and the decision mask according to SARG04 protocol
         """
-        out = list()
-        for i, d in enumerate(decision):
-            qubitMeasured = []
-            if d == 1:
-                #If used basis is Hadamard, then choose the photon
-                #in normal basis
-                if basis[i] == 1:
-                    #if normal basis, choose this one, else the other
-                    if data[i][0]['state']['0'] in [0,1]:
-                        qubitMeasured = [data[i][0]['state']['0'], data[i][0]['state']['1']]
-                    else:
-                        qubitMeasured = [data[i][1]['state']['0'], data[i][1]['state']['1']]
-                    q = qubit(0)
-                    bit = q.readState(qubitMeasured[0], qubitMeasured[1])
-                    out.append(bit)
-                #if not hadamard basis, then choose the photon in hadamard
-                #basis
-                else:
-                    if data[i][0]['state']['0'] not in [0,1]:
-                        qubitMeasured = [data[i][0]['state']['0'], data[i][0]['state']['1']]
-                    else:
-                        qubitMeasured = [data[i][1]['state']['0'], data[i][1]['state']['1']]
-                    q = qubit(0)
-                    bit = q.readState(qubitMeasured[0], qubitMeasured[1])
-                    out.append(bit)
-        return out
+        decided = decision.bits().astype(bool)
+        first, second = data[decided, 0], data[decided, 1]
+        #If used basis is Hadamard, then choose the photon
+        #in normal basis, else the photon in hadamard basis
+        hadamard = basis.bits()[decided] == 1
+        codes = where(hadamard == (first < STATE_PLUS), first, second)
+        return read_states(codes)
 
     def __store_key__(self, data):
-        key = list()
-        for i in range (len(data)):
-            key.append(data[i])
-        return key
+        return BitVector(data)
 
     def __comparison_with_measurements__(self,data):   #1.2 (second step receiver)
-        self.__debug_print__('\x1b[0;33;40m' + 'CC Received possibilities -> ' + str(data) + '\x1b[0m')
+        logger.debug('CC Received possibilities -> %s', data)
+        pairs = self.__deserialize_pairs__(data)
         #Compare the measured qubits with the 2 possibilities for each proposed by the sender
-        self.receiverData["validation"] = self.__compare_qbits__(self.receiverData["measurements"],data)
-        ret = self.receiverData["validation"]
-        self.__debug_print__('\x1b[0;33;40m' + 'Decision : ' + str(self.receiverData["validation"]) + '\x1b[0m')
-        test = self.receiverData["measurements"]
+        self.receiverData["validation"] = self.__compare_qbits__(self.receiverData["measurements"],pairs)
+        ret = self.receiverData["validation"].encode()
+        logger.debug('Decision : %s', self.receiverData["validation"])
         #compute the secret key from the receiver's side
-        key = self.__compute_secret__(data,self.receiverData["computed-basis"], self.receiverData["validation"])
+        key = self.__compute_secret__(pairs,self.receiverData["computed-basis"], self.receiverData["validation"])
         #store the key in self.key
         self.key = self.__store_key__(key)
-        if len(self.key) > 2:
-            s = hex(int(''.join(map(str, self.key)), 2))
-        else:
-            s = str(self.key)
-        self.__info_print__('\x1b[0;33;40m' + 'Secret Key : ' + s + '\x1b[0m')
+        logger.info('Secret Key : %s', lazy(key_str, self.key))
         return ret, 13
 
     def __waiting_synchro__(self, data):
@@ -232,54 +192,47 @@ class Protocol():
         This function is used to reverse the basis to create the basis for the
         second possibility of qubit according to the protocol SARG04"
         """
-        newBasis = list()
-        for i in range(len(basis)):
-            if basis[i] == 0:
-                newBasis.append(1)
-            else:
-                newBasis.append(0)
-        return newBasis
+        return BitVector(basis.bits() ^ 1)
 
     def __list_of_possibilities__(self, value1, value2):
         """
-        This function creates the list containing the possibility pair for each
-        qubit using the two input lists.
+        This function creates the (N, 2) array containing the possibility pair
+        for each qubit using the two input arrays of state codes.
         """
         assert len(value1) == len(value2)
-        possibilities = list()
-        tmp = list()
-        #Create the possibility list with a pair of value for each qubit
-        for i in range(len(value1)):
-            possibilities.append([value1[i],value2[i]])
-            tmp.append([value1[i],value2[i]])
         #Shuffle the position of the value for each pair
-        for k in range(len(possibilities)):
-            random.Random(11).shuffle(possibilities[k],random.random)
-        return possibilities
+        swaps = random_bits(self.rng, len(value1)).astype(bool)
+        return stack((where(swaps, value2, value1), where(swaps, value1, value2)), axis=1)
+
+    def __serialize_pairs__(self, pairs):
+        """
+        Puts the (N, 2) array of state codes in the wire format, always as
+        one packed batch of 2N photons: the pairs are classical data, and
+        serializing them as qubit couples made SARG04 cost 3N photon dicts
+        per round instead of the N of BB84
+        """
+        return pack_photons(pairs.reshape(-1))
 
     def __sending_possibilities__(self,data):      #2.1 (second step sender)
-        self.senderData["data2"] = self.__generate_random_bits__(self.N)
+        self.senderData["data2"] = self.__generate_random_bits__(len(self.senderData["data"]))
         self.senderData["basis2"] = self.__reverse_basis__(self.senderData["basis"])
         #Create the first list of possibilities of qubits
-        ret = self.__compute_photons__(self.senderData["data"],self.senderData["basis"])
+        ret = encode_photons(self.senderData["data"],self.senderData["basis"])
         #Create the second list of possibilities of qubits
-        ret2 = self.__compute_photons__(self.senderData["data2"],self.senderData["basis2"])
+        ret2 = encode_photons(self.senderData["data2"],self.senderData["basis2"])
         #Create the list with the couple of possibilities ret and ret2
-        ret3 = self.__list_of_possibilities__(ret,ret2)
-        self.__debug_print__('\x1b[0;31;40m' + str(self.eid) + ' -> CC : ' + str(ret3) + '\x1b[0m')
+        pairs = self.__list_of_possibilities__(ret,ret2)
+        ret3 = self.__serialize_pairs__(pairs)
+        logger.debug('%s -> CC : %s', self.eid, ret3)
         return ret3, 22
 
     def __create_shared_key__(self, key, decision):
         """
         This function creat the shared key between the sender and the receiver
-        by dropping or validating the key elements using the decision list.
+        by dropping or validating the key elements using the decision mask.
         """
         assert len(key) == len(decision)
-        sharedKey = list()
-        for i in range (len(key)):
-            if decision[i]  != 'x':
-                sharedKey.append(key[i])
-        return sharedKey
+        return BitVector(key.bits()[decision.bits().astype(bool)])
 
     def __results_reception__(self,data): #2.2 (third step sender)
         #get the info and the name of sender
@@ -287,14 +240,10 @@ class Protocol():
         name = next(iter(data[info]))
         #then get rid of the info and the name
         data = data[info][name]
-        self.__debug_print__('\x1b[0;31;40m CC -> ' + str(self.eid) + ': ' + str(data) + '\x1b[0m')
+        logger.debug('CC -> %s: %s', self.eid, data)
         #Compute the Shared key between the sender and the receiver
-        self.key = self.__create_shared_key__(self.senderData["data"],data)
-        if len(self.key) > 2:
-            s = hex(int(''.join(map(str, self.key)), 2))
-        else:
-            s = str(self.key)
-        self.__info_print__('\x1b[0;31;40m' + str(self.eid) + ' Secret Key : ' + s + '\x1b[0m')
+        self.key = self.__create_shared_key__(self.senderData["data"],BitVector.decode(data))
+        logger.info('%s Secret Key : %s', self.eid, lazy(key_str, self.key))
         return None, 3
 
     def __done__(self, data):
@@ -0,0 +1,114 @@
+"""
+Bank of the protocols of every house of a residential area (or of every
+house known by the CC), used by the simulators to skip the houses with
+nothing to do when stepping them.
+"""
+from numpy import zeros, int16, intp, flatnonzero
+from utils.communicationLayer import comLayer
+
+DONE = 3 #state of a crypto layer with nothing left to send or receive
+
+
+class ProtocolBank():
+    """
+    Holds the communication layers of many houses and skips the idle ones.
+    The current state of every house is mirrored in a NumPy array, so that the
+    houses with nothing to do (done, no input and no message to send) are
+    skipped with one mask. The other ones are run one by one, each with its
+    own state machine: their steps read and write per house data, so they are
+    not batched.
+    """
+    def __init__(self, capacity=64):
+        self.layers = []     #comLayer of each house
+        self.keys = {}       #index of each house by key (house id)
+        #state mirrors, allocated for capacity houses and doubled when full
+        self._states = zeros(capacity, dtype=int16)   #current state of each house
+        self._wake = zeros(capacity, dtype=bool)      #houses to step even if they are done
+        self.stepped = zeros(0, dtype=intp)   #houses run by the last step
+        return
+
+    @property
+    def states(self):
+        return self._states[:len(self.layers)]
+
+    @property
+    def wake(self):
+        return self._wake[:len(self.layers)]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, protocol, key=None):
+        """
+        Adds the protocol of a house to the bank and returns its index.
+        @key : optional id used to find the house back with index()
+        """
+        layer = comLayer(protocol, protocol.__get_states_mapping__())
+        index = len(self.layers)
+        if index == len(self._states):
+            self._states = self.__grow__(self._states)
+            self._wake = self.__grow__(self._wake)
+        self.keys[key if key is not None else index] = index
+        self.layers.append(layer)
+        self._states[index] = layer.__state__
+        self._wake[index] = False
+        return index
+
+    def __grow__(self, array):
+        grown = zeros(max(1, 2*len(array)), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def index(self, key):
+        return self.keys[key]
+
+    def layer(self, index):
+        return self.layers[index]
+
+    def protocol(self, index):
+        return self.layers[index].protocol
+
+    def add_message(self, index, message):
+        """
+        Adds a message to be sent by the house at index
+        """
+        self.layers[index].__add_message_to_be_send__(message)
+        self.wake[index] = True
+        return
+
+    def step(self, inputs=None, time=None):
+        """
+        Runs one step of every house that has something to do.
+        @inputs : dict of the received data by house index (houses without
+        data may be left out)
+        @time : simulation time (seconds) given to the stepped protocols
+        Returns the list of the output of every house (None for skipped houses)
+        """
+        inputs = inputs or {}
+        outputs = [None]*len(self.layers)
+        awake = (self.states != DONE) | self.wake
+        if inputs:
+            awake[list(inputs)] = True
+        active = flatnonzero(awake)
+        self.stepped = active
+        states, wake = self.states, self.wake
+        for i in active.tolist():
+            layer = self.layers[i]
+            if time is not None:
+                layer.protocol.time = time
+            outputs[i] = layer.__doStep__(inputs.get(i))
+            states[i] = layer.__state__
+            #a house which is done may still have a queued message or a top up to start
+            wake[i] = layer.__state__ == DONE and layer.protocol.__pending__()
+        return outputs
+
+    def idle(self):
+        """
+        True if no house has anything to do, including the top up of its key pool
+        """
+        if ((self.states != DONE) | self.wake).any():
+            return False
+        return not any(layer.protocol.__below_watermark__() for layer in self.layers)
@@ -0,0 +1,123 @@
+"""
+Sink of the simulation outputs (counters of the crypto layers) recorded by
+the CC for every house.
+"""
+import json
+import os
+from numpy import empty, dtype as np_dtype
+
+COUNTERS = ('n1', 'n2', 'n3', 'n4', 'n5', 'n6', 'n7', 'n8')
+FORMATS = {'json': '.json', 'parquet': '.parquet', 'hdf5': '.h5'}
+
+
+class MetricsSink():
+    """
+    Buffers the records and writes them every `buffer` records (and on
+    close) through a single open handle.
+
+    Columnar formats (parquet, hdf5) use the schema
+    (run, N, p, house, time, n1..n8). parquet writes one file per simulation
+    (N, p) in the <path>.parquet directory, hdf5 appends to the 'metrics'
+    table of <path>.h5. Their libraries (pyarrow, h5py) are only imported
+    when the format is used.
+    json keeps the original output: one {"N-p": outputs} line per record.
+
+    @path : output file, without extension
+    @run : id of the run (simulation number)
+    @N : qubits per QKD round of the simulation
+    @p : Eve attack probability of the simulation
+    """
+    def __init__(self, path, run, N, p, fmt='json', buffer=1024):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown metrics format: %s' % fmt)
+        self.path = path + FORMATS[fmt]
+        self.run = str(run)
+        self.N = N
+        self.p = p
+        self.fmt = fmt
+        self.buffer = buffer
+        self.handle = None   #open file (json, hdf5) or parquet writer
+        self.records = 0
+        self.lines = []
+        self.columns = {name: [] for name in ('house', 'time') + COUNTERS}
+        return
+
+    def add(self, house, time, outputs):
+        """
+        Records the outputs of a house at a given simulation time
+        """
+        if self.fmt == 'json':
+            self.lines.append(json.dumps({str(self.N)+'-'+str(self.p): outputs}) + '\n')
+        else:
+            self.columns['house'].append(str(house))
+            self.columns['time'].append(time)
+            for name in COUNTERS:
+                self.columns[name].append(outputs.get(name, 0))
+        self.records += 1
+        if self.records >= self.buffer:
+            self.flush()
+        return
+
+    def flush(self):
+        """
+        Writes the buffered records
+        """
+        if not self.records:
+            return
+        getattr(self, '__write_%s__' % self.fmt)()
+        self.records = 0
+        self.lines = []
+        self.columns = {name: [] for name in self.columns}
+        return
+
+    def close(self):
+        self.flush()
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        return
+
+    def __write_json__(self):
+        if self.handle is None:
+            self.handle = open(self.path, 'a+')
+        self.handle.writelines(self.lines)
+        self.handle.flush()
+        return
+
+    def __write_parquet__(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        n = self.records
+        table = pa.table({'run': pa.array([self.run]*n, pa.string()),
+                          'N': pa.array([self.N]*n, pa.int32()),
+                          'p': pa.array([self.p]*n, pa.float64()),
+                          'house': pa.array(self.columns['house'], pa.string()),
+                          'time': pa.array(self.columns['time'], pa.int64()),
+                          **{name: pa.array(self.columns[name], pa.int64()) for name in COUNTERS}})
+        if self.handle is None:
+            os.makedirs(self.path, exist_ok=True)
+            name = '%s-%s.parquet' % (self.N, self.p)
+            self.handle = pq.ParquetWriter(os.path.join(self.path, name), table.schema)
+        self.handle.write_table(table)
+        return
+
+    def __write_hdf5__(self):
+        import h5py
+        if self.handle is None:
+            self.handle = h5py.File(self.path, 'a')
+            if 'metrics' not in self.handle:
+                text = h5py.string_dtype()
+                row = np_dtype([('run', text), ('N', 'i4'), ('p', 'f8'), ('house', text), ('time', 'i8')]
+                               + [(name, 'i8') for name in COUNTERS])
+                self.handle.create_dataset('metrics', shape=(0,), maxshape=(None,), dtype=row, chunks=True)
+        table = self.handle['metrics']
+        rows = empty(self.records, dtype=table.dtype)
+        rows['run'] = self.run
+        rows['N'] = self.N
+        rows['p'] = self.p
+        for name, values in self.columns.items():
+            rows[name] = values
+        table.resize((len(table) + self.records,))
+        table[-self.records:] = rows
+        self.handle.flush()
+        return
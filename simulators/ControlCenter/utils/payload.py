@@ -0,0 +1,146 @@
+"""
+Codecs of the metering payloads (readings and responses) exchanged between
+the houses and the CC. They turn a value into the bytes encrypted by the
+crypto layer (OTP, AES), so that compact encodings consume fewer secret bits.
+The binary codecs end their payloads with a check byte, so that a payload
+decrypted with a wrong key fails to decode (and is counted as an undetected
+error) instead of giving a wrong value.
+"""
+from struct import pack, unpack, error
+from math import isfinite
+from zlib import crc32
+
+SCALE = 1000     #fixed point values are kept with 3 decimals, like the text readings
+KEYFRAME = 16    #the delta codec sends a full value every KEYFRAME messages
+
+
+def seal(data):
+    """
+    Appends the check byte of data (low byte of its CRC-32)
+    """
+    return data + bytes([crc32(data) & 0xff])
+
+
+def check(data):
+    """
+    Returns data without its check byte, raises ValueError if it does not match
+    """
+    if not data or crc32(data[:-1]) & 0xff != data[-1]:
+        raise ValueError('payload check byte mismatch')
+    return data[:-1]
+
+
+class TextCodec():
+    """
+    Decimal text rounded to 3 decimals (the original wire format)
+    """
+    def encode(self, value):
+        return str(round(value, 3)).encode()
+
+    def decode(self, data):
+        return float(data.decode('latin-1'))
+
+
+class FixedPointCodec():
+    """
+    Signed 32 bits integer of thousandths, and a check byte
+    """
+    def encode(self, value):
+        try:
+            return seal(pack('>i', round(value*SCALE)))
+        except error:
+            raise ValueError('%s is out of range of the fixed point codec' % value)
+
+    def decode(self, data):
+        data = check(data)
+        if len(data) != 4:
+            raise ValueError('fixed point payloads are 4 bytes long')
+        return unpack('>i', data)[0]/SCALE
+
+
+class Float32Codec():
+    """
+    IEEE 754 single precision float, and a check byte
+    """
+    def encode(self, value):
+        return seal(pack('>f', value))
+
+    def decode(self, data):
+        data = check(data)
+        if len(data) != 4:
+            raise ValueError('float32 payloads are 4 bytes long')
+        value = unpack('>f', data)[0]
+        if not isfinite(value):
+            raise ValueError('float32 payload is not a finite number')
+        return value
+
+
+class VarintDeltaCodec():
+    """
+    Difference of thousandths with the previous value of the link, zigzag
+    and varint (LEB128) encoded, and a check byte. Slow changing readings
+    take 2 to 4 bytes.
+    Both ends count the messages of the link, and every KEYFRAME messages the
+    full value is sent. After a corrupted message, the values decoded from
+    the wrong base are rejected too, up to the next keyframe.
+    An instance holds the state of one direction of a link.
+    """
+    def __init__(self):
+        self.sent = (0, 0)       #(last value, messages) encoded
+        self.received = (0, 0)   #(last value, messages) decoded
+        self.corrupted = False   #the base of the next deltas is wrong
+        return
+
+    def encode(self, value):
+        last, count = self.sent
+        value = round(value*SCALE)
+        delta = value - (last if count % KEYFRAME else 0)
+        self.sent = (value, count + 1)
+        delta = (delta << 1) ^ (delta >> 63)   #zigzag, small magnitudes give small codes
+        out = bytearray()
+        while delta > 0x7f:
+            out.append(0x80 | (delta & 0x7f))
+            delta >>= 7
+        out.append(delta)
+        return seal(bytes(out))
+
+    def decode(self, data):
+        last, count = self.received
+        #the message is counted even if it is invalid, to stay in step with the sender
+        self.received = (last, count + 1)
+        if count % KEYFRAME == 0:
+            self.corrupted = False
+        try:
+            data = check(data)
+        except ValueError:
+            self.corrupted = True
+            raise
+        delta, shift = 0, 0
+        for i, byte in enumerate(data):
+            delta |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        if not data or byte & 0x80 or i != len(data) - 1 or shift > 70:
+            self.corrupted = True
+            raise ValueError('malformed varint payload')
+        delta = (delta >> 1) ^ -(delta & 1)
+        value = delta + (last if count % KEYFRAME else 0)
+        self.received = (value, count + 1)
+        if self.corrupted:
+            raise ValueError('varint delta applied to a corrupted value')
+        return value/SCALE
+
+
+CODECS = {'text': TextCodec,
+          'fixed': FixedPointCodec,
+          'float32': Float32Codec,
+          'varint': VarintDeltaCodec}
+
+
+def codec(name=None):
+    """
+    Returns a new codec (text by default). Stateful codecs need one instance
+    per link, used by the crypto layer of the link on both ends.
+    """
+    return CODECS[name or 'text']()
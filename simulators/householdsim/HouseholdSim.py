@@ -3,6 +3,7 @@ import logging
 import mosaik_api
 
 import model as HouseModel
+from utils.log import configure
 
 
 logger = logging.getLogger('householdsim')
@@ -29,6 +30,7 @@ meta = {
                 'num_hh',  # Number of separate households within the house
                 'num_res',  # Number of residents per household
                 'hhrequest', #Quantum request outputs
+                'hhnext', #Time (seconds) of the next step of the houses
             ],
         },
     },
@@ -55,10 +57,11 @@ class HouseholdSim(mosaik_api.Simulator):
         self.protocol = None
         self.hhrequest = None
 
-    def init(self, sid, N, protocol, Eve, drFreq = 60, pos_loads=True):
+    def init(self, sid, N, protocol, Eve, drFreq = 60, pos_loads=True, options=None):
         """
         @N : number of qubit exchanged each round
         @protocol : BB84, KMB09, ...
+        @options : optional QKD settings, forwarded to every house protocol
         """
         logger.debug('Loads will be %s numbers.' %
                      ('positive' if pos_loads else 'negative'))
@@ -68,6 +71,8 @@ class HouseholdSim(mosaik_api.Simulator):
         self.eve = Eve
         self.protocol = protocol
         self.dr_freq = drFreq
+        self.options = options or {}
+        configure(self.options)
         return self.meta
 
     def create(self, num, model, sim_start, profile_file, grid_name):
@@ -85,7 +90,7 @@ class HouseholdSim(mosaik_api.Simulator):
             pf = open(profile_file, 'rt')
 
         try:
-            self.model = HouseModel.HouseModel(pf, grid_name, self.N, self.protocol, self.eve, self.dr_freq)
+            self.model = HouseModel.HouseModel(pf, grid_name, self.N, self.protocol, self.eve, self.dr_freq, self.options, self.sid)
             self.houses_by_eid = {
                 eid(i): house for i, house in enumerate(self.model.houses)
                 #eid(i): self.model.houses[i] for i in range(0, 2)
@@ -111,7 +116,7 @@ class HouseholdSim(mosaik_api.Simulator):
         minutes = time // 60
         minutes_offset = minutes + self._offset
         cache = {}
-        data = self.model.step(minutes_offset, inputs)
+        data = self.model.step(minutes_offset, inputs, time)
         if time % 60 == 0:
             for hid, d in enumerate(data):
                 d *= self.pos_loads  # Flip sign if necessary
@@ -119,9 +124,16 @@ class HouseholdSim(mosaik_api.Simulator):
                 self._cache = cache
         #self.model.resolution is the step size value for the simulation
         if self.model._wait == True:
-            return (minutes + self.model.resolution) * 60
+            next_step = (minutes + self.model.resolution) * 60
+        elif not self.model.idle():
+            next_step = time+1 #an exchange is running, simulate each second
         else:
-            return time+1 #simulate each second
+            #nothing can happen before the next profile line or demand send
+            next_step = max(time+1, (self.model.next_event(minutes_offset) - self._offset) * 60)
+        #the CC sleeps until then at most, to receive the exchanges started then
+        for house in self.model.houses:
+            house['hhnext'] = next_step
+        return next_step
 
 
 
@@ -3,7 +3,8 @@
 """
 import json
 import arrow
-from utils.communicationLayer import comLayer
+from utils.bank import ProtocolBank
+from utils.randomness import stream
 import datetime
 import importlib
 
@@ -16,7 +17,7 @@ class HouseModel:
     associated meta data to allow and easier access to it.
 
     """
-    def __init__(self, data, lv_grid, N, protocol, eve, dr_freq):
+    def __init__(self, data, lv_grid, N, protocol, eve, dr_freq, options=None, sid=''):
         # Process meta data
         assert next(data).startswith('# meta')
         meta = json.loads(next(data))
@@ -35,6 +36,7 @@ class HouseModel:
         self.data = data
         self.eve = True if eve["type"] == 1 else False
         self.eveP = 0 if self.eve == False else eve["probability"]
+        self.options = options or {}
 
         self.protocol = importlib.import_module('utils.'+protocol["crypto"])
         self.qkd = protocol["qkd"]
@@ -69,16 +71,23 @@ class HouseModel:
 
         #: List of house info dicts
         self.houses = []
+        #: Protocols of all the houses, the idle ones are skipped when stepping
+        self.bank = ProtocolBank()
         for i, n in enumerate(self.node_ids):
-            p = importlib.import_module('utils.'+protocol["crypto"]).Protocol(N, n, self.eve, self.eveP, protocol["qkd"])
+            rng = stream(self.options.get('seed'), '%s.House_%s' % (sid, i))
+            p = importlib.import_module('utils.'+protocol["crypto"]).Protocol(N, n, self.eve, self.eveP, protocol["qkd"], self.options, rng)
+            p.refill = True #houses start the conversations, so they start the key top ups
+            index = self.bank.add(p, 'House_%s' % i)
             self.houses.append({
                 'num': i + 1,
                 'node_id': n,
                 'num_hh': attrs['num_hh'][i % self.num_profiles],
                 'num_res': attrs['num_residents'][i % self.num_profiles],
                 'protocol': p,
-                'commLayer': comLayer(p, p.__get_states_mapping__()),
+                'index': index,
+                'commLayer': self.bank.layer(index),
                 'hhrequest': None,
+                'hhnext': 0,
                 'next_send': 0,
             })
 
@@ -87,7 +96,7 @@ class HouseModel:
         self._cache = None
         self._wait = False
 
-    def step(self, time, inputs):
+    def step(self, time, inputs, seconds=None):
         """Get the current load for all houses for *minutes* minutes since
         :attr:`start`.
 
@@ -95,6 +104,9 @@ class HouseModel:
         the next smaller multiple of 15 will be used. For example, if you
         pass ``minutes=23``, you'll get the value for ``15``.
 
+        *seconds* is the simulation time in seconds, used as the clock of
+        the house protocols like the CC does.
+
         """
         # Trim "minutes" to multiples of "self.resolution"
         # Example: res=15, minutes=40 -> minutes == 30
@@ -109,7 +121,7 @@ class HouseModel:
                 if date == target_date:
                     # Found target date, cache results:
                     values = list(map(float, values))
-                    self._cache = self.compute_step(values, time, inputs)
+                    self._cache = self.compute_step(values, time, inputs, seconds)
                     self._last_date = date
                     break
                 else:
@@ -119,38 +131,62 @@ class HouseModel:
                                     'out of range.' % (target_date, time))
         elif self._wait == False or time > self.next_dr:
             #QKD
-            for i, house in enumerate(self.houses):
-                out = self.compute_comm_layer_step(house, minutes, inputs.get('House_'+str(i)))
+            for house in self.houses:
+                self.queue_demand(house, minutes)
+            for out in self.compute_comm_layer_step(inputs, seconds):
                 if out == -1:
                     self.reponseReceived += 1
-                house['hhrequest'] = out if out != -1 else None
-            if self.reponseReceived == len(self.houses): #All houses has received a message
+            #All houses has received a message (and topped up their key pool)
+            if self.reponseReceived >= len(self.houses) and self.bank.idle():
                 self._wait = True
                 self.reponseReceived = 0
         return self._cache
 
-    def compute_step(self, values, time, inputs):
+    def compute_step(self, values, time, inputs, seconds=None):
         ret = []
         for i, house in enumerate(self.houses):
             power_consumption = values[i % self.num_profiles]
-            data = inputs.get('House_'+str(i))
-            out = self.compute_comm_layer_step(house, time, data, power_consumption)
-            house['hhrequest'] = out if out != -1 else None
+            self.queue_demand(house, time, power_consumption)
             ret.append(power_consumption)
+        self.compute_comm_layer_step(inputs, seconds)
         return ret
 
-    def compute_comm_layer_step(self, house, time, data, power_consumption = None):
+    def queue_demand(self, house, time, power_consumption = None):
         if power_consumption != None:
             self.consumption += power_consumption
         #Send every `dr_freq` data demand
         if time >= house['next_send'] and self.consumption != 0:
-            house['commLayer'].__add_message_to_be_send__(str(round(self.consumption,3)))
+            self.bank.add_message(house['index'], self.consumption)
             self.consumption = 0
             self._wait = False
             house['next_send'] += self.dr_freq
-        out = house['commLayer'].__doStep__(data)
-        return out
 
+    def compute_comm_layer_step(self, inputs, seconds=None):
+        """Runs one step of the protocols of all the houses and returns their
+        outputs (-1 when a house received a message)"""
+        received = {}
+        for eid, data in (inputs or {}).items():
+            if data and eid in self.bank:
+                received[self.bank.index(eid)] = data
+        outs = self.bank.step(received, seconds)
+        for house, out in zip(self.houses, outs):
+            house['hhrequest'] = out if out != -1 else None
+        return outs
+
+
+    def idle(self):
+        """True if no house has an exchange running or waits for a response of the CC"""
+        return self.bank.idle() and not any(house['protocol'].awaiting for house in self.houses)
+
+    def next_event(self, minutes):
+        """Time (in minutes, like step()) of the next event of the houses
+        when they are idle: the next profile line, or an earlier demand send"""
+        event = (minutes // self.resolution + 1) * self.resolution
+        if self.consumption != 0:
+            sends = [house['next_send'] for house in self.houses if house['next_send'] > minutes]
+            if sends:
+                event = min(event, min(sends))
+        return event
 
     def get_delta(self, date):
         """Get the amount of minutes between *date* and :attr:`start`.
@@ -2,11 +2,13 @@ from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 from base64 import b64encode, b64decode
 from Crypto.Util.Padding import pad, unpad
-import sys
 import importlib
+from utils.sizing import RoundSizing
+from utils.keypool import KeyPool
+from utils.payload import codec
+from utils.log import get_logger
 
-INFO = False
-DEBUG = False
+logger = get_logger('AES')
 
 class Protocol():
     """This class is used to run AES. It uses a given QKD protocol to
@@ -19,12 +21,14 @@ class Protocol():
     None: nothing to send
     -1: Message received"""
 
-    def __init__(self, N, eid, eve=False, eveP=0, qkd=''):
+    def __init__(self, N, eid, eve=False, eveP=0, qkd='', options=None, rng=None):
         """
         @N : Number of qubit exchanged each second
         @protocol : Protocol of QKD to use.
+        @options : Optional simulation settings shared by every layer (see QKD_OPTIONS)
+        @rng : Random stream of the QKD protocol, derived from eid if None
         """
-        self.protocol = importlib.import_module('utils.'+qkd).Protocol(N, eid, eve, eveP)
+        self.protocol = importlib.import_module('utils.'+qkd).Protocol(N, eid, eve, eveP, options, rng)
         self.isSender = False
         self.eid = eid
         self.N = N
@@ -34,8 +38,34 @@ class Protocol():
         self.sD = []
         #A dictionary of all messages received
         self.rD = []
+        options = options or {}
         #Shared secret stack
-        self.secret = []
+        self.secret = KeyPool(options.get('key_pool_capacity'))
+        #Encoding of the exchanged values into the encrypted payloads
+        self.codec = codec(options.get('payload_codec'))
+        #QKD rounds the sender may run in one exchange to fill the secret stack
+        self.max_rounds = options.get('max_rounds') or 1
+        #Start the next QKD round in the last message of the current one
+        self.coalesce = options.get('coalesce', False)
+        #Size the QKD rounds to get the missing secret in one round
+        self.adaptive = options.get('adaptive_sizing', False)
+        self.sizing = RoundSizing(N, options.get('sizing_overshoot') or 2.0)
+        #Top up the pool to this many bits while there is no traffic
+        self.watermark = options.get('key_watermark') or 0
+        if self.secret.capacity is not None:
+            self.watermark = min(self.watermark, self.secret.capacity)
+        self.refill = False   #start the top ups (set on the side starting the conversations)
+        self.awaiting = False #a response to the last sent message is expected
+        self.target = 0       #pool level aimed at by the running top up
+        #Session keys: one QKD key encrypts (with AES-GCM) up to session_messages
+        #messages, during session_seconds at most (None: no limit). Off when both are unset.
+        self.session_messages = options.get('aes_session_messages')
+        self.session_seconds = options.get('aes_session_seconds')
+        self.sessions = self.session_messages is not None or self.session_seconds is not None
+        self.session = None         #current session: id, key, messages encrypted with it and start time
+        self.sending_sessions = None #sessions of the messages being sent, one id per message
+        self.sending = 0            #number of queued messages sent by the running exchange
+        self.time = 0               #simulation time (seconds), set by the simulator
         self.outputs = {
             "n1": 0,
             "n2": 0,
@@ -44,6 +74,7 @@ class Protocol():
             "n5": 0,
             'n6': 3600, #Min latency Time (second) per round of message sending
             'n7': 0, #Max latency Time (second) per round of message sending
+            'n8': 0, #Number of secret bits in the key pool
         }
         self.eve = eve
         self.eveP = eveP
@@ -64,38 +95,102 @@ class Protocol():
                  23: self.__send_message__, #Send the message using the shared secret
                  3:  self.__done__ }
 
-    def __debug_print__(self, msg):
-        if DEBUG is True:
-            print('\x1b[0;31;40m' + '[DEBUG] : ' + msg + '\x1b[0m', file=sys.stdout, flush=True)
+    def __update_outputs__(self, error = 0):
+        rounds = self.protocol.rounds
+        qubits = self.protocol.qubits
+        #Each merged round would have taken the steps of one more QKD round
+        self.elapsed_time += self.protocol.steps*(rounds - 1)
+        self.outputs["n1"] += 3*rounds
+        self.outputs["n4"] += qubits
+        self.outputs["n5"] += (qubits - len(self.protocol.key))
+        #Rounds discarded: the whole exchange, or the rounds intercepted by Eve
+        self.outputs["n2"] += max(error, self.protocol.lost)
+        if not self.target: #top ups are not part of a message latency
+            self.outputs["n6"] = min(self.elapsed_time, self.outputs["n6"])
+            self.outputs["n7"] = max(self.elapsed_time, self.outputs["n7"])
+        self.outputs["n8"] = self.secret.level()
         return
+    def __missing__(self):
+        """
+        Secret bits still needed by the pending message (or by the top up)
+        """
+        return max(self.secret.reserved, self.target) - self.secret.level()
+
+    def __below_watermark__(self):
+        return self.secret.level() < self.watermark
 
-    def __info_print__(self, msg):
-        if INFO is True:
-            print('\x1b[0;31;40m' + '[INFO] : ' + msg + '\x1b[0m', file=sys.stdout, flush=True)
+    def __pending__(self):
+        """
+        True if there is something to start when done: a queued message or,
+        when idle, a top up of the pool
+        """
+        return len(self.sD) > 0 or (self.refill and not self.awaiting and self.__below_watermark__())
+
+    def __plan_round__(self):
+        """
+        Chooses the qubits of the next QKD exchange started as the sender:
+        one round sized to get the missing secret (adaptive sizing), or as
+        many merged rounds of N qubits as needed up to max_rounds
+        """
+        missing = self.__missing__()
+        rounds, qubits = 1, self.N
+        if self.adaptive:
+            qubits = self.sizing.qubits(missing)
+        elif self.max_rounds > 1:
+            rounds = self.sizing.rounds(missing, self.max_rounds)
+            qubits = self.N*rounds
+        self.protocol.rounds = rounds
+        self.protocol.qubits = qubits
         return
 
-    def __update_outputs__(self, error = 0):
-        self.outputs["n1"] += 3
-        self.outputs["n4"] += self.N
-        self.outputs["n5"] += (self.N - len(self.protocol.key))
-        self.outputs["n2"] += error
-        self.outputs["n6"] = min(self.elapsed_time, self.outputs["n6"])
-        self.outputs["n7"] = max(self.elapsed_time, self.outputs["n7"])
+    def __with_rounds__(self, message):
+        """
+        Tells the receiver how many rounds were merged in the exchange
+        """
+        if self.protocol.rounds > 1:
+            message["rounds"] = self.protocol.rounds
+        return message
+
+    def __receive_round__(self, message, photons):
+        """
+        Starts a QKD round as the receiver of photons, with the number of
+        merged rounds announced in message
+        """
+        self.protocol.rounds = message.get("rounds", 1)
+        return self.__qkd__(photons)
+
+    def __end_round__(self):
+        """
+        Stores the secret of the finished QKD round (or counts its error)
+        """
+        if self.state == 3:
+            self.sizing.observe(self.protocol.qubits, len(self.protocol.key))
+            self.secret.deposit(self.protocol.key)
+            self.__update_outputs__()
+        #If an error occured, we do not store this secret
+        if self.state == 4:
+            self.__update_outputs__(1)
         return
-    def __update_undetected_error__(self, message):
+
+    def __update_undetected_error__(self, payload):
         '''
-        Checks whether the message is a valid float or not.
-        Used for simulation outputs
+        Decodes a received payload and checks whether it is a valid value or not.
+        Returns the value (None if invalid). Used for simulation outputs
         '''
         try:
-            float(message)
-            return
+            #a payload that could not be decrypted is decoded as an empty one
+            #(invalid for every codec), so that stateful codecs stay in step
+            return self.codec.decode(payload if payload is not None else b'')
         except ValueError:
             self.outputs["n3"] += 1
-            return
+            return None
 
     def __add_message__(self, message):
-        self.sD.append({"msg": message, "length": len(message)})
+        """
+        Queues a value to be sent, encoded with the payload codec
+        """
+        payload = self.codec.encode(message)
+        self.sD.append({"msg": payload, "length": len(payload)})
         return
 
     def __str_from_bits__(self, bits):
@@ -106,33 +201,90 @@ class Protocol():
         n = int(''.join(map(str, bits)), 2)
         return n.to_bytes((n.bit_length() + 7) // 8, 'big').decode('latin-1')
 
-    def bitsToBytes(self, a):
-        a = [0] * (8 - len(a) % 8) + a # adding in extra 0 values to make a multiple of 8 bits
-        s = ''.join(str(x) for x in a)[::-1] # reverses and joins all bits
-        returnInts = []
-        for i in range(0,len(s),8):
-            returnInts.append(bytes([int(s[i:i+8],2)])) # goes 8 bits at a time to save as ints
-        return returnInts
-
     def __Encryption__(self, message, bits):
-        k = b''.join(self.bitsToBytes(bits[:255]))
+        k = bits.tobytes() #32 bytes, the last bit is padding
         cipher = AES.new(k, AES.MODE_ECB)
-        ciphertext = cipher.encrypt(pad(str.encode(message),self.BLOCK_SIZE))
+        ciphertext = cipher.encrypt(pad(message,self.BLOCK_SIZE))
         return b64encode(ciphertext).decode('utf-8')
 
     def __Decryption__(self, ciphertext, bits):
-        k = b''.join(self.bitsToBytes(bits[:255]))
+        k = bits.tobytes()
         cipher = AES.new(k, AES.MODE_ECB)
         try:
-            plaintext = unpad(cipher.decrypt(b64decode(ciphertext)),self.BLOCK_SIZE)
-            p = plaintext.decode('utf-8')
+            p = unpad(cipher.decrypt(b64decode(ciphertext)),self.BLOCK_SIZE)
         except ValueError:
-            #bad message received, update the output value accordingly
-            self.outputs["n3"] += 1
-            p = 'error'
+            #bad message received, counted when it is decoded
+            p = None
         return p
 
 
+    def __next_sessions__(self, messages):
+        """
+        Ids of the sessions to use for the given number of messages, one per
+        message (None without sessions): the current session until it is
+        full or expired, then new sessions of at most session_messages messages
+        """
+        if not self.sessions:
+            return None
+        session = self.session
+        if session is None:
+            id, count = 0, 0
+        elif self.session_seconds is not None and self.time - session["start"] >= self.session_seconds:
+            id, count = session["id"] + 1, 0
+        else:
+            id, count = session["id"], session["messages"]
+        ids = []
+        for _ in range(messages):
+            if self.session_messages is not None and count >= self.session_messages:
+                id, count = id + 1, 0
+            ids.append(id)
+            count += 1
+        return ids
+
+    def __key_bits__(self, sessions, messages):
+        """
+        Secret bits needed to encrypt messages: one key per message without
+        sessions, else one key per session other than the current one
+        """
+        if sessions is None:
+            return 255*messages
+        current = self.session["id"] if self.session is not None else None
+        return 255*len(set(sessions) - {current})
+
+    def __open_session__(self, session):
+        """
+        Returns the session with the given id, starting it with the next key
+        of the secret stack if it is not the current one
+        """
+        if self.session is None or self.session["id"] != session:
+            self.session = {"id": session,
+                            "key": self.secret.consume(255).tobytes(),
+                            "messages": 0,
+                            "start": self.time}
+        return self.session
+
+    def __seal__(self, message, session):
+        """
+        Encrypts and authenticates a message with the session key (AES-GCM).
+        Both ends count the messages of a session, so the count is used as nonce.
+        """
+        nonce = session["messages"].to_bytes(12, 'big')
+        session["messages"] += 1
+        cipher = AES.new(session["key"], AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(message)
+        return b64encode(nonce + tag + ciphertext).decode('utf-8')
+
+    def __unseal__(self, message, session):
+        data = b64decode(message)
+        session["messages"] += 1
+        cipher = AES.new(session["key"], AES.MODE_GCM, nonce=data[:12])
+        try:
+            p = cipher.decrypt_and_verify(data[28:], data[12:28])
+        except ValueError:
+            #bad message received, counted when it is decoded
+            p = None
+        return p
+
     def __get_message_or_response__(self, data):
         '''
         Since every response message looks like {'response': {'Entity': ...}}
@@ -169,10 +321,10 @@ class Protocol():
         self.isSender = False
         self.state = 0
         self.rD.append({"msg": '', "length": data['aesl']})
-        if len(self.secret) >= 255:
+        if self.secret.reserve(self.__key_bits__(data.get('session'), data['aesn'])):
             return self.__receive_message__(data)
         else:
-            qkd = self.__qkd__(data['qkd'])
+            qkd = self.__receive_round__(data, data['qkd'])
             return {"aes": "", "qkd": qkd}, 12 #__secret_gen__
 
     def __start_sender__(self, data):
@@ -190,30 +342,45 @@ class Protocol():
         self.isSender = True
         self.state = 0
 
-        if len(self.secret) >= 255:
+        #The messages queued from now on wait for the next exchange
+        self.sending = len(self.sD)
+        self.sending_sessions = self.__next_sessions__(self.sending)
+        if self.secret.reserve(self.__key_bits__(self.sending_sessions, self.sending)):
             return self.__send_message__(None) #Send message directly
         else:
+            self.__plan_round__()
             qkd = self.__qkd__(data)
-            return {"aesl": len(self.sD[0]['msg']), "qkd": qkd}, 22 #__qkd_loop__
+            ret = {"aesl": sum(len(msg['msg']) for msg in self.sD), "aesn": self.sending, "qkd": qkd}
+            if self.sending_sessions is not None:
+                ret["session"] = self.sending_sessions
+            return self.__with_rounds__(ret), 22 #__qkd_loop__
 
     def __secret_gen__(self, data):
         self.elapsed_time += 1
-        if self.state == 3:
-            self.secret.extend(self.protocol.key)
-            self.__update_outputs__()
-        #If an error occured, we do not store this secret
-        if self.state == 4:
-            self.__update_outputs__(1)
-        if self.state in [3,4] and len(self.secret) < 255: #end of QKD process
-            if data is None:
-                return {"aes": '', "qkd": ''}, 12
+        self.__end_round__()
+        #0: the last round is stored, the sender did not start the next one yet
+        if self.state in [0,3,4] and self.__missing__() > 0: #end of QKD process
             self.state = 0
-            qkd = self.__qkd__(self.__get_message_or_response__(data)['qkd'])
+            if data is None:
+                return None, 12 #__secret_gen__
+            message = self.__get_message_or_response__(data)
+            qkd = self.__receive_round__(message, message['qkd'])
             return {"aes": '', "qkd": qkd}, 12 #__secret_gen__
 
+        elif self.state > 10 and data is None: #the response of the other side is late
+            return None, 12 #__secret_gen__
         elif self.state > 10:
-            qkd = self.__qkd__(self.__get_message_or_response__(data)['qkd'])
+            message = self.__get_message_or_response__(data)
+            qkd = self.__qkd__(message['qkd'])
+            if self.state in [3,4] and 'next' in message:
+                #Coalesced message: the sender already started the next round
+                self.__end_round__()
+                self.state = 0
+                qkd = self.__receive_round__(message, message['next'])
             return {"aes": '', "qkd": qkd}, 12 #__secret_gen__
+        elif self.target: #end of the top up
+            self.target = 0
+            return None, 3
         else:
             return None, 13 #__receive_message__
 
@@ -223,58 +390,102 @@ class Protocol():
         Do QKD until the shared secret stack is large enough to perform AES
         """
         self.elapsed_time += 1
-        if self.state == 3:
-            self.secret.extend(self.protocol.key)
-            self.__update_outputs__()
-        #If an error occured, we do not store this secret
-        if self.state == 4:
-            self.__update_outputs__(1)
-        if self.state in [3,4] and len(self.secret) < 255:
+        self.__end_round__()
+        if self.state in [3,4] and self.__missing__() > 0:
             self.state = 0
+            self.__plan_round__()
             qkd = self.__qkd__(None) #to start BB84 as sender
-            return {"aes": 1, "qkd": qkd}, 22 #__qkd_loop__
+            return self.__with_rounds__({"aes": 1, "qkd": qkd}), 22 #__qkd_loop__
+        elif self.state > 10 and data is None: #the response of the other side is late
+            return None, 22 #__qkd_loop__
         elif self.state > 10:
-                qkd = self.__qkd__({'response': {self.eid: self.__get_message_or_response__(data)['qkd']}})
-                return {"aes": 0, "qkd": qkd}, 22 #__qkd_loop__
+            qkd = self.__qkd__({'response': {self.eid: self.__get_message_or_response__(data)['qkd']}})
+            if self.coalesce and self.state in [3,4]:
+                #End the round now and send the photons of the next one with this message
+                self.__end_round__()
+                self.state = 0 #the round is already stored
+                if self.__missing__() > 0:
+                    self.__plan_round__()
+                    return self.__with_rounds__({"aes": 0, "qkd": qkd, "next": self.__qkd__(None)}), 22 #__qkd_loop__
+            return {"aes": 0, "qkd": qkd}, 22 #__qkd_loop__
+        elif self.target: #end of the top up
+            self.target = 0
+            return None, 3
         else:
             return None, 23 #__send_message__
 
     def __send_message__(self, data):
         """
-        Use the shared secret to perform AES over the message to be sent
+        Use the shared secret to perform AES over the messages to be sent
+        The messages queued when the exchange started are sent together
         """
         self.elapsed_time += 1
-        msg = self.sD.pop(0)
-        aes = self.__Encryption__(msg['msg'], self.secret)
-        #We need to delete the part of the shared secret stack used
-        self.secret = self.secret[255:]
+        msgs, self.sD = self.sD[:self.sending], self.sD[self.sending:]
+        ret = {"aesl": sum(len(msg['msg']) for msg in msgs), "aesn": len(msgs), "control": -2}
+        if self.sending_sessions is None:
+            #Each message has its own key, deleted from the shared secret stack
+            ret["aes"] = [self.__Encryption__(msg['msg'], self.secret.consume(255)) for msg in msgs]
+        else:
+            #Each new session takes its key out of the shared secret stack
+            ret["aes"] = [self.__seal__(msg['msg'], self.__open_session__(session))
+                          for msg, session in zip(msgs, self.sending_sessions)]
+            ret["session"] = self.sending_sessions
+        self.outputs["n8"] = self.secret.level()
         self.state = 0
-        #Sending encrypted message
-        return {"aesl": len(msg['msg']), "aes": aes, "control": -2}, 3
+        self.awaiting = True
+        #Sending encrypted messages
+        return ret, 3
 
     def __receive_message__(self, data):
         self.elapsed_time += 1
         #If dara is None, wait until data is received
         if data is None:
             return None, 13
-        #First decrypt the message
+        #First decrypt the messages, in order
         data = self.__get_message_or_response__(data)
-        self.rD[0]['msg'] = self.__Decryption__(data['aes'], self.secret)
-        #Then delete shared key used
-        self.secret = self.secret[255:]
-        self.__info_print__(str(self.eid) + ' received message: ' + str(self.rD[0]['msg']))
-        #check if it is an undetected error by checking if this message is a valid float
-        self.__update_undetected_error__(self.rD[0]['msg'])
+        for i, aes in enumerate(data['aes']):
+            if 'session' in data:
+                payload = self.__unseal__(aes, self.__open_session__(data['session'][i]))
+            else:
+                #The key of each message is taken out of the pool
+                payload = self.__Decryption__(aes, self.secret.consume(255))
+            #check if it is an undetected error by checking if this payload decodes to a valid value
+            self.rD[0]['msg'] = self.__update_undetected_error__(payload)
+            logger.info('%s received message: %s', self.eid, self.rD[0]['msg'])
+        self.outputs["n8"] = self.secret.level()
         #remove the first received message
         self.rD.pop(0)
         #resetting the Quantum Protocol state
         self.state = 0
+        self.awaiting = False
         return -1, 3 #Message received.
 
+    def __start_refill__(self, data):
+        """
+        Runs QKD rounds to top up the pool to the watermark while idle.
+        @data : None on the side starting the top up, else its first message
+        """
+        self.state = 0
+        if data is None:
+            self.isSender = True
+            self.target = self.watermark
+            self.__plan_round__()
+            qkd = self.__qkd__(None)
+            return self.__with_rounds__({"refill": self.target, "qkd": qkd}), 22 #__qkd_loop__
+        self.isSender = False
+        self.target = data['refill']
+        qkd = self.__receive_round__(data, data['qkd'])
+        return {"aes": "", "qkd": qkd}, 12 #__secret_gen__
+
     def __done__(self, data):
         self.elapsed_time = 0
+        message = self.__get_message_or_response__(data)
+        if message and 'refill' in message: #top up started by the other side
+            return self.__start_refill__(message)
         if data and 'response' in data or data and 'aesl' in data: #restart as a receiver
             return self.__start_receiver__(self.__get_message_or_response__(data))
         elif len(self.sD) >0: #restart as sender
             return self.__start_sender__(None)
+        elif self.__pending__(): #top up the pool while idle
+            return self.__start_refill__(None)
         return None,3
@@ -1,45 +1,43 @@
 
-from utils.qubit import qubit
-import random
-from numpy import matrix
+from utils.qubit import count_photons, encode_photons, serialize_photons, pack_photons, deserialize_photons, measure_photons
+from utils.randomness import stream, random_bits
+from utils.bitvector import BitVector
 from math import pow
-import sys
+from numpy import zeros, uint8
+from utils.log import get_logger, lazy, key_str
 
-INFO = True
-DEBUG = False
+logger = get_logger('KMB09', rounds=True)
 VERIFICATION = 5
 
 class Protocol():
-    def __init__(self, N, eid, eve=False, eveP=0):
+    def __init__(self, N, eid, eve=False, eveP=0, options=None, rng=None):
         self.eid = eid
         self.N = N                #N is the number of qubit exchanged each QKD round
         self.isSender = True      #Needed to know if the current QKD
                                   #is for receiving or sending information
         self.senderData = {
-            "data": [],           #Received qubit
-            "basis": []           #Random Basis used by the receiver for a given sender
+            "data": BitVector(),           #Received qubit
+            "basis": BitVector()           #Random Basis used by the receiver for a given sender
         }
 
         self.receiverData = {
-            "received-qubits": [], #Received qubit
-            "computed-basis": []  #Random Basis used by the receiver for a given sender
+            "received-qubits": BitVector(), #Received qubit
+            "computed-basis": BitVector()  #Random Basis used by the receiver for a given sender
         }
         #Common values :
         self.commonQubits = []
-        self.key = [] #secret shared
+        self.key = BitVector() #secret shared
         self.eve = eve
         self.eveP = eveP
         self.error = False #Set to true if Eve is present
-        return
-
-    def __debug_print__(self, msg):
-        if DEBUG is True:
-            print('[DEBUG] : ' + msg, file=sys.stdout, flush=True)
-        return
-
-    def __info_print__(self, msg):
-        if INFO is True:
-            print('[INFO] : ' + msg, file=sys.stdout, flush=True)
+        self.rounds = 1    #QKD rounds merged in the current exchange (set by the crypto layer)
+        self.qubits = N    #qubits of the current exchange (set by the sender's crypto layer)
+        self.lost = 0      #merged rounds of the current exchange dropped because of Eve
+        self.steps = 3     #simulation steps of a QKD round
+        options = options or {}
+        self.packed = options.get('packed', False) #Send photons with the compact wire format
+        #Random stream of this entity, seeded from the simulation seed
+        self.rng = rng if rng is not None else stream(options.get('seed'), eid)
         return
 
     def __get_states_mapping__(self):
@@ -66,12 +64,9 @@ class Protocol():
             return self.receiverData
 
     def __generate_random_bits__(self, N):
-        """ This function generates a list of N random bits.
+        """ This function generates a vector of N random bits.
         """
-        aux = list()
-        for i in range(N):
-            aux.append(random.randint(0,1))
-        return aux
+        return BitVector(random_bits(self.rng, N))
 
     def __compute_photons__(self, data, basis):
         """
@@ -79,42 +74,28 @@ class Protocol():
         over the network.
         """
         assert len(data) == len(basis), "Basis and data must be the same length!"
-        message = list()
-        for i in range(len(data)):
-            if not basis[i]:
-                #Base computacional
-                if not data[i]:
-                    message.append(qubit(0).serialize())
-                else:
-                    message.append(qubit(1).serialize())
-            else:
-                #Base Hadamard
-                if not data[i]:
-                    tmp = qubit(0)
-                else:
-                    tmp = qubit(1)
-                tmp.hadamard()
-                message.append(tmp.serialize())
-        return message
+        return self.__serialize__(encode_photons(data, basis))
+
+    def __bits_to_wire__(self, bits):
+        """
+        Puts a vector of bits in the wire format selected for this protocol
+        """
+        if self.packed:
+            return bits.encode()
+        return bits.tolist()
+
+    def __serialize__(self, codes):
+        """
+        Puts state codes in the wire format selected for this protocol
+        """
+        if self.packed:
+            return pack_photons(codes)
+        return serialize_photons(codes)
 
     def __deserialize__(self, data, basis):
-        """This function deserialize a list of serialized qubit into a list
-        of qubit object, and use a basis to change their value accordingly"""
-        out = list()
-        i = 0
-        for value in data:
-            q = qubit(0)
-            #Deserializing qubit...
-            q.state = matrix([[value['state']['0']], [value['state']['1']]])
-            #add basis
-            if not basis[i]:
-                mes = q.measure(0)
-                out.append(mes)
-            else:
-                mes = q.measure(1)
-                out.append(mes)
-            i = i+1
-        return out
+        """This function deserialize a list of serialized qubit and measures
+        all of them at once with the given basis"""
+        return BitVector(measure_photons(deserialize_photons(data), basis, self.rng))
 
     def __IDLE__(self, data=None):
         """
@@ -122,8 +103,9 @@ class Protocol():
         If data is false, QKD will start as the sender of the secret.
         Return next step to do
         """
-        self.key = []
+        self.key = BitVector()
         self.error = False
+        self.lost = 0
         if data != None:
             self.isSender = False
             return self.__start_receiver__(data)
@@ -131,21 +113,24 @@ class Protocol():
             return self.__start_sender__(data)
 
     def __start_receiver__(self, data):
-        self.__debug_print__('\x1b[0;33;40m' + 'CC Received Qubits -> ' + str(data) + '\x1b[0m')
+        logger.debug('CC Received Qubits -> %s', data)
         #Compute the random basis to interprete incoming qubits
-        self.receiverData["computed-basis"] = self.__generate_random_bits__(self.N)
-        self.__debug_print__('\x1b[0;33;40m' + 'Computed basis : ' + str(self.receiverData["computed-basis"]) + '\x1b[0m')
+        #The sender chooses the number of qubits of each exchange
+        n = count_photons(data)
+        self.qubits = n
+        self.receiverData["computed-basis"] = self.__generate_random_bits__(n)
+        logger.debug('Computed basis : %s', self.receiverData["computed-basis"])
         #Receive qubits and compute the right result with the previous random basis
         self.receiverData["received-qubits"] = self.__deserialize__(data, self.receiverData["computed-basis"])
-        self.__debug_print__('\x1b[0;33;40m' + 'Measured bits : ' + str(self.receiverData["received-qubits"]) + '\x1b[0m')
+        logger.debug('Measured bits : %s', self.receiverData["received-qubits"])
         return None, 12
 
     def __start_sender__(self, data):
-        self.senderData["data"]  = self.__generate_random_bits__(self.N)
-        self.senderData["basis"] = self.__generate_random_bits__(self.N)
+        self.senderData["data"]  = self.__generate_random_bits__(self.qubits)
+        self.senderData["basis"] = self.__generate_random_bits__(self.qubits)
         ret = self.__compute_photons__(self.senderData["data"], self.senderData["basis"])
-        self.__debug_print__('\x1b[0;31;40m' + str(self.eid) + ' -> CC : ' + str(ret) + '\x1b[0m')
-        self.__debug_print__('\x1b[0;31;40m' + str(self.eid) + ' random key : ' + str(self.senderData["basis"]) + '\x1b[0m')
+        logger.debug('%s -> CC : %s', self.eid, ret)
+        logger.debug('%s random key : %s', self.eid, self.senderData["basis"])
         #return value to the simulator, and next step value
         return ret, 21
 
@@ -158,73 +143,94 @@ class Protocol():
 
     def __compare_index__(self,index1,index2):
         """
-        This function is used to compare two list of index and to create the
-        difference index list
+        This function is used to compare two vectors of index and to create the
+        difference index mask
         """
-        validation = list()
         assert len(index1) == len(index2)
-        for i in range(len(index1)):
-            if index1[i] == index2[i]:
-                validation.append('x')
-            else:
-                validation.append(1)
-        return validation
+        return BitVector(index1.bits() != index2.bits())
 
     def __create_key__(self,basis, validation):
         """
-        This function is used to create the secret key with the difference index
-        list
+        This function is used to create the secret key bits with the difference
+        index mask: the key bit is the opposite of the basis used
         """
-        secretKey = list()
         assert len(basis) == len(validation)
-        for i in range(len(basis)):
-            if validation[i] == 1:
-                if basis[i] == 0:
-                    secretKey.append(1)
-                else:
-                    secretKey.append(0)
-        return secretKey
+        return basis.bits()[validation.bits().astype(bool)] ^ 1
 
     def __store_key__(self, data):
         """
-        This fonction is used to store the key in a new list
+        This fonction is used to store the key in a new bit vector
+        """
+        return BitVector(data)
+
+    def __intercept_rounds__(self, common):
+        """
+        Eve intercepts each merged round with eveP probability, with the
+        outcome of a single round: the interception is detected unless the
+        verification bits of the round are unchanged (0.5**verification
+        chance). The detected rounds are removed from the common mask, the
+        undetected ones are kept with the key bits changed by Eve.
+        Returns the new common mask, and the mask of the changed key bits.
+        """
+        bits = common.bits()
+        changed = zeros(len(bits), dtype=uint8)
+        size = self.qubits//self.rounds
+        self.lost = 0
+        for r in range(self.rounds):
+            if self.rng.random() >= self.eveP:
+                continue
+            verif = self.__get_verification_length__(int(bits[r*size:(r+1)*size].sum()))
+            if self.rng.random() < pow(0.5, verif):
+                changed[r*size:(r+1)*size] = 1
+            else:
+                bits[r*size:(r+1)*size] = 0
+                self.lost += 1
+        if self.lost:
+            logger.debug('%s Eve intercepted %s of %s rounds', self.eid, self.lost, self.rounds)
+        self.error = self.lost == self.rounds
+        return BitVector(bits), changed[bits.astype(bool)]
+
+    def __change_key__(self, changed):
+        """
+        Replaces the key bits of the rounds Eve intercepted undetected by random bits
         """
-        key = list()
-        for i in range (len(data)):
-            key.append(data[i])
-        return key
+        if changed is not None and changed.any():
+            self.key = BitVector(self.key.bits() ^ (changed & self.__generate_random_bits__(len(self.key)).bits()))
+        return
 
     def __comparaison_with_index_measured__(self,data): #1.2 (second step receiver)
-        self.__debug_print__('\x1b[0;33;40m' + 'CC Received index -> ' + str(data) + '\x1b[0m')
+        logger.debug('CC Received index -> %s', data)
         #compare the index between the sender and the receiver
         #self.receiverData["validation"] = self.__compare_index__(data, self.receiverData["received-qubits"])
-        self.commonQubits = self.__compare_index__(data, self.receiverData["received-qubits"])
-        self.__debug_print__('\x1b[0;33;40m' + ' Common index -> CC : ' + str(self.commonQubits) + '\x1b[0m')
+        self.commonQubits = self.__compare_index__(BitVector.decode(data), self.receiverData["received-qubits"])
+        changed = None
+        if self.eve == True and self.rounds > 1:
+            self.commonQubits, changed = self.__intercept_rounds__(self.commonQubits)
+        logger.debug('Common index -> CC : %s', self.commonQubits)
         #Create the Secret key from the receiver's side
         key = self.__create_key__(self.receiverData["computed-basis"],self.commonQubits)
         self.key = self.__store_key__(key)
         verif = self.__get_verification_length__(len(self.key))
-        ret = {'common': self.commonQubits, 'key-verification': self.key[:verif], 'id': self.eid}
+        ret = {'common': self.commonQubits.encode(), 'key-verification': self.key[:verif].tolist(), 'id': self.eid}
+        if self.lost:
+            ret['lost'] = self.lost
+        self.__change_key__(changed)
 
         #If Eve, change the secret key value with eveP probability
         #This step allows you to change the value of the start of the key to be sent,
         #and to change the secret key value
-        if self.eve == True:
-            if random.random()<self.eveP:
+        if self.eve == True and self.rounds == 1:
+            if self.rng.random() < self.eveP:
                 self.key = self.__generate_random_bits__(len(self.key))
                 tmp = ret['key-verification'] #used to check if the new key is different
-                ret['key-verification'] = self.__generate_random_bits__(verif)
-                self.__debug_print__('\x1b[0;33;31m' + str(self.eid) + ' Eve interception : ' + str(ret) + '\x1b[0m')
+                ret['key-verification'] = self.__generate_random_bits__(verif).tolist()
+                logger.debug('%s Eve interception : %s', self.eid, ret)
                 if tmp != ret['key-verification']:
                     self.error = True
 
         #key is the last n-VERIFICATION bits of the initial key:
-        self.key = self.key[verif:]
-        if len(self.key) > 2:
-            s = hex(int(''.join(map(str, self.key)), 2))
-        else:
-            s = str(self.key)
-        self.__info_print__('\x1b[0;33;40m' + str(self.eid) + ' Secret Key : ' + s + '\x1b[0m')
+        self.key.consume(verif)
+        logger.info('%s Secret Key : %s', self.eid, lazy(key_str, self.key))
         return ret, 13
 
     def __waiting_synchro__(self, data):
@@ -235,21 +241,17 @@ class Protocol():
 
     def __sending_index__(self,data):   #2.1 (second step sender)
         #Sending the Index to the receiver
-        ret = self.senderData["data"]
-        self.__debug_print__('\x1b[0;31;40m' + str(self.eid) + ' -> CC : ' + str(ret) + '\x1b[0m')
+        ret = self.__bits_to_wire__(self.senderData["data"])
+        logger.debug('%s -> CC : %s', self.eid, ret)
         return ret, 22
 
     def __create_shared_key__(self, key, decision):
         """
         This function creat the shared key between the sender and the receiver
-        by dropping or validating the key elements using the decision list.
+        by dropping or validating the key elements using the decision mask.
         """
         assert len(key) == len(decision)
-        sharedKey = list()
-        for i in range (len(key)):
-            if decision[i]  != 'x':
-                sharedKey.append(key[i])
-        return sharedKey
+        return BitVector(key.bits()[decision.bits().astype(bool)])
 
     def __results_reception__(self,data):   #2.2 (third step sender)
         if data is None:
@@ -260,28 +262,22 @@ class Protocol():
         #then get rid of the info and the name
         data= data[info][name]
         #here, we just received common index, need to check
-        self.commonQubits = data['common']
-        self.__debug_print__('\x1b[0;31;40m CC -> ' + str(self.eid) + ': ' + str(self.commonQubits) + '\x1b[0m')
+        self.commonQubits = BitVector.decode(data['common'])
+        #the rounds intercepted by Eve are already out of the common mask
+        self.lost = data.get('lost', 0)
+        self.error = self.error or self.lost == self.rounds
+        logger.debug('CC -> %s: %s', self.eid, self.commonQubits)
         #Compute the Shared key between the sender and the receiver
         self.key= self.__create_shared_key__(self.senderData["basis"],self.commonQubits)
         keyVerif = data['key-verification']
         verif = self.__get_verification_length__(len(self.key))
-        key = self.key[:verif]
-        self.key = self.key[verif:]
+        key = self.key.consume(verif)
         if key == keyVerif and not self.error:
-            if len(self.key) > 2:
-                s = hex(int(''.join(map(str, self.key)), 2))
-            else:
-                s = str(self.key)
-            self.__info_print__('\x1b[0;31;40m' + str(self.eid) + ' Secret Key : ' + s + '\x1b[0m')
-            self.__debug_print__('\x1b[0;33;40m' + data['id'] + ' Secret key ('+ str(100*(pow(0.75, verif))) + '% chance that there was a MITM), ('+ str(len(self.key)) +' bits): ' + s + '\x1b[0m')
+            logger.info('%s Secret Key : %s', self.eid, lazy(key_str, self.key))
+            logger.debug('%s Secret key (%s%% chance that there was a MITM), (%s bits): %s', data['id'], 100*(pow(0.75, verif)), len(self.key), lazy(key_str, self.key))
             return None, 3
         else:
-            if len(self.key) > 1:
-                val = hex(int(''.join(map(str, self.key)), 2))
-            else:
-                val = '0x'
-            self.__info_print__('\x1b[0;33;40m' + data['id'] + ' Key is invalid! MITM detected ('+ str(100*(1-pow(0.75, verif))) + '% sure): '+ val +' \x1b[0m')
+            logger.info('%s Key is invalid! MITM detected (%s%% sure): %s', data['id'], 100*(1-pow(0.75, verif)), lazy(self.key.hex))
             return None, 4
 
     def __done__(self, data):
@@ -0,0 +1,160 @@
+"""
+Packed bit vector used for keys, sifting data and shared secret stacks.
+Bits are stored 8 per byte in a uint8 numpy buffer instead of one Python int
+per bit.
+"""
+from base64 import b64encode, b64decode
+from numpy import asarray, uint8, zeros, packbits, unpackbits, frombuffer, bitwise_xor, concatenate, array_equal
+
+
+class BitVector():
+    """
+    Growable vector of bits.
+    extend() appends in place in an over-allocated buffer and consume()
+    removes bits from the front by moving an offset, so that a key or a
+    secret stack can be filled and emptied without copying it every time.
+    """
+    __slots__ = ('_buf', '_start', '_stop')
+
+    def __init__(self, bits=()):
+        bits = asarray(bits, dtype=uint8).reshape(-1)
+        self._buf = packbits(bits)
+        self._start = 0            #offset (in bits) of the first bit in self._buf
+        self._stop = len(bits)     #offset (in bits) after the last bit
+
+    @classmethod
+    def from_bytes(cls, data, length=None):
+        """
+        Builds a vector from bytes, keeping the first length bits (8 per byte by default)
+        """
+        vector = cls()
+        vector._buf = frombuffer(data, dtype=uint8).copy()
+        vector._stop = 8*len(data) if length is None else length
+        return vector
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __array__(self, dtype=None, copy=None):
+        bits = self.bits()
+        return bits if dtype is None else bits.astype(dtype)
+
+    def bits(self):
+        """
+        Returns the unpacked bits as a uint8 array
+        """
+        first, last = self._start >> 3, (self._stop + 7) >> 3
+        offset = self._start & 7
+        return unpackbits(self._buf[first:last])[offset:offset + len(self)]
+
+    def tolist(self):
+        return self.bits().tolist()
+
+    def tobytes(self):
+        """
+        Returns the bits packed 8 per byte, the last byte being padded with 0
+        """
+        if self._start & 7:
+            return packbits(self.bits()).tobytes()
+        out = self._buf[self._start >> 3:(self._stop + 7) >> 3].copy()
+        if self._stop & 7:
+            out[-1] &= (0xff << (8 - (self._stop & 7))) & 0xff
+        return out.tobytes()
+
+    def hex(self):
+        return hex(int.from_bytes(self.tobytes(), 'big') >> (-len(self) % 8))
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return BitVector(self.bits()[index])
+        return int(self.bits()[index])
+
+    def __eq__(self, other):
+        if isinstance(other, BitVector):
+            return len(self) == len(other) and array_equal(self.bits(), other.bits())
+        return self.tolist() == list(other)
+
+    def __xor__(self, other):
+        """
+        Xors the bits of self with the first len(self) bits of other
+        """
+        assert len(other) >= len(self), "Not enough bits to xor with!"
+        if not (self._start | other._start) & 7:
+            size = (len(self) + 7) >> 3
+            first, second = self._start >> 3, other._start >> 3
+            out = bitwise_xor(self._buf[first:first + size], other._buf[second:second + size])
+            return BitVector.from_bytes(out.tobytes(), len(self))
+        return BitVector(self.bits() ^ other.bits()[:len(self)])
+
+    def extend(self, other):
+        """
+        Appends the bits of other (a BitVector or a sequence of bits) in place
+        """
+        bits = other.bits() if isinstance(other, BitVector) else asarray(other, dtype=uint8).reshape(-1)
+        n = len(bits)
+        if not n:
+            return
+        self.__reserve__(self._stop + n)
+        first = self._stop >> 3
+        if self._stop & 7:
+            #complete the last partial byte
+            bits = concatenate((unpackbits(self._buf[first:first + 1])[:self._stop & 7], bits))
+        packed = packbits(bits)
+        self._buf[first:first + len(packed)] = packed
+        self._stop += n
+
+    def consume(self, n):
+        """
+        Removes the first n bits and returns them
+        """
+        n = min(n, len(self))
+        if self._start & 7:
+            out = self[:n]
+        else:
+            #byte aligned: the packed bytes are copied without unpacking them
+            first = self._start >> 3
+            out = BitVector.from_bytes(self._buf[first:first + ((n + 7) >> 3)].tobytes(), n)
+        self._start += n
+        if self._start == self._stop:
+            self._start = self._stop = 0
+        return out
+
+    def __reserve__(self, stop):
+        """
+        Makes room for bits up to the offset stop. The consumed bytes are
+        dropped first, and the buffer only grows (doubling) if that is not enough.
+        """
+        size = (stop + 7) >> 3
+        if size <= len(self._buf):
+            return
+        first = self._start >> 3
+        used = ((self._stop + 7) >> 3) - first
+        if size - first <= len(self._buf):
+            buf = self._buf
+        else:
+            buf = zeros(max(size - first, 2*len(self._buf)), dtype=uint8)
+        buf[:used] = self._buf[first:first + used]
+        self._buf = buf
+        self._start -= 8*first
+        self._stop -= 8*first
+
+    def encode(self):
+        """
+        Wire format: the bits packed 8 per byte and base64 wrapped, with their number
+        """
+        return {'n': len(self), 'bits': b64encode(self.tobytes()).decode('ascii')}
+
+    @classmethod
+    def decode(cls, message):
+        """
+        Inverse of encode, also accepts a plain list of bits
+        """
+        if isinstance(message, dict):
+            return cls.from_bytes(b64decode(message['bits']), message['n'])
+        return cls(message)
+
+    def __repr__(self):
+        return 'BitVector(%s)' % ''.join(map(str, self.tolist()))
@@ -0,0 +1,68 @@
+"""
+Pool of shared secret bits used by the crypto layers (OTP, AES).
+Both ends of a QKD link deposit the same keys and consume the same amounts,
+so their pools stay in sync as long as they use the same capacity.
+"""
+from utils.bitvector import BitVector
+
+
+class KeyPool():
+    """
+    FIFO of secret bits, backed by a BitVector so that consuming bits from the
+    front moves an offset instead of copying the remaining stack.
+
+    @capacity : maximum number of bits kept (None for no limit). Bits reserved
+    for a pending message may go over it, so that a message larger than the
+    capacity can still be sent.
+    """
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.bits = BitVector()
+        self.reserved = 0   #bits promised to pending messages
+        self.dropped = 0    #bits discarded because the pool was full
+        return
+
+    def __len__(self):
+        return len(self.bits)
+
+    def level(self):
+        """
+        Number of secret bits in the pool
+        """
+        return len(self.bits)
+
+    def available(self):
+        """
+        Number of secret bits that are not reserved by a pending message
+        """
+        return len(self.bits) - self.reserved
+
+    def is_full(self):
+        return self.capacity is not None and len(self.bits) >= max(self.capacity, self.reserved)
+
+    def deposit(self, key):
+        """
+        Adds a freshly shared key to the pool, up to its capacity.
+        Returns the number of bits kept.
+        """
+        kept = len(key)
+        if self.capacity is not None:
+            kept = max(0, min(kept, max(self.capacity, self.reserved) - len(self.bits)))
+            self.dropped += len(key) - kept
+        self.bits.extend(key if kept == len(key) else key[:kept])
+        return kept
+
+    def reserve(self, n):
+        """
+        Reserves n bits for a message waiting to be sent or received.
+        Returns True if they are already in the pool.
+        """
+        self.reserved += n
+        return len(self.bits) >= self.reserved
+
+    def consume(self, n):
+        """
+        Removes the first n bits of the pool and returns them
+        """
+        self.reserved = max(0, self.reserved - n)
+        return self.bits.consume(n)
@@ -0,0 +1,84 @@
+"""
+Logging of the protocol (BB84, SARG04, KMB09) and crypto (OTP, AES) modules.
+Each module has its own logger under 'qkd', off (WARNING) by default, and
+its messages are formatted only when they are emitted.
+"""
+import logging
+import sys
+
+ROOT = 'qkd'
+FORMAT = '[%(levelname)s] %(name)s: %(message)s'
+
+
+class lazy():
+    """
+    Argument of a log message computed only when the message is emitted
+    """
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+def key_str(key):
+    """
+    Short form of a key: hex, or its bits when it is too short
+    """
+    return key.hex() if len(key) > 2 else str(key.tolist())
+
+
+class Sampler(logging.Filter):
+    """
+    Keeps one in every `every` messages of each kind (same format string),
+    used for the messages logged at each QKD round
+    """
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = every
+        self.counts = {}
+
+    def filter(self, record):
+        if self.every <= 1:
+            return True
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+sampler = Sampler()
+
+
+def get_logger(module, rounds=False):
+    """
+    Returns the logger of a module.
+    @rounds : the module logs at every QKD round, its messages are sampled
+    """
+    logger = logging.getLogger(ROOT + '.' + module)
+    if rounds and sampler not in logger.filters:
+        logger.addFilter(sampler)
+    return logger
+
+
+def configure(options=None):
+    """
+    Sets the levels of the module loggers from the options of a simulator.
+    log_levels maps a module name (or '*' for all of them) to a level name,
+    log_sample keeps one in every log_sample messages logged at each round.
+    """
+    options = options or {}
+    root = logging.getLogger(ROOT)
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        root.addHandler(handler)
+        root.propagate = False
+    levels = dict(options.get('log_levels') or {})
+    root.setLevel(levels.pop('*', logging.WARNING))
+    for module, level in levels.items():
+        logging.getLogger(ROOT + '.' + module).setLevel(level)
+    sampler.every = options.get('log_sample') or 1
+    return
@@ -1,6 +1,7 @@
 from random import randint
 from math import pow, sqrt
-from numpy import matrix
+from base64 import b64encode, b64decode
+from numpy import matrix, array, asarray, zeros, uint8, frombuffer
 
 class qubit():
     """
@@ -60,3 +61,96 @@ class qubit():
         {'state' : self.state}
         """
         return {'state': {'0': round(self.state.item(0),1), '1': round(self.state.item(1),1)}}
+
+
+#Batch API: a whole QKD round is handled as an array of small integer codes,
+#code = data + 2*basis, instead of one qubit object per photon.
+STATE_0, STATE_1, STATE_PLUS, STATE_MINUS, STATE_UNKNOWN = range(5)
+
+def _serialized_state(code):
+    q = qubit(code & 1)
+    if code >> 1:
+        q.hadamard()
+    return q.serialize()
+
+#Precomputed tables, indexed by state code
+SERIALIZED = [_serialized_state(code) for code in range(STATE_UNKNOWN)]
+CODES = {(s['state']['0'], s['state']['1']): code for code, s in enumerate(SERIALIZED)}
+#MEASURE[code][basis] is the measured bit, -1 when the outcome is random
+MEASURE = array([[0, -1], [1, -1], [-1, 0], [-1, 1], [-1, -1]])
+READ_STATE = array([0, 1, 0, 1, -1])
+SHIFTS = array([6, 4, 2, 0], dtype=uint8)   #bit offsets of the 4 photons of a packed byte
+
+def encode_photons(data, basis):
+    """
+    Computes the state code of every photon of a round in one operation.
+    """
+    data = asarray(data, dtype=uint8)
+    basis = asarray(basis, dtype=uint8)
+    assert data.shape == basis.shape, "Basis and data must be the same length!"
+    return data + 2*basis
+
+def serialize_photons(codes):
+    """
+    Serializes an array of state codes exactly like qubit.serialize()
+    """
+    return [SERIALIZED[code] for code in codes.tolist()]
+
+def pack_photons(codes):
+    """
+    Compact wire format: 2 bits per photon, base64 wrapped so it survives
+    mosaik's JSON. The number of photons is sent along since the last byte
+    may be padded.
+    """
+    codes = asarray(codes, dtype=uint8).reshape(-1)
+    quads = zeros(-(-len(codes)//4)*4, dtype=uint8)
+    quads[:len(codes)] = codes
+    quads = quads.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return {'n': len(codes), 'photons': b64encode(packed.tobytes()).decode('ascii')}
+
+def unpack_photons(message):
+    """
+    Inverse of pack_photons: returns the array of state codes
+    """
+    n = message['n']
+    packed = frombuffer(b64decode(message['photons']), dtype=uint8)
+    return ((packed[:, None] >> SHIFTS) & 3).reshape(-1)[:n]
+
+def deserialize_photons(data):
+    """
+    Inverse of serialize_photons (or pack_photons): returns the array of
+    received state codes
+    """
+    if isinstance(data, dict):
+        return unpack_photons(data)
+    return array([CODES.get((value['state']['0'], value['state']['1']), STATE_UNKNOWN)
+                  for value in data], dtype=uint8)
+
+def count_photons(data):
+    """
+    Number of photons of a serialized (or packed) batch
+    """
+    if isinstance(data, dict):
+        return data['n']
+    return len(data)
+
+def measure_photons(codes, basis, rng):
+    """
+    Measures every received state with the receiver basis, like qubit.measure()
+    does for one photon. The random outcomes of mismatched basis all come from
+    a single draw of the rng Generator.
+    """
+    codes = asarray(codes, dtype=uint8)
+    basis = asarray(basis, dtype=uint8)
+    assert codes.shape == basis.shape, "Basis and states must be the same length!"
+    out = MEASURE[codes, basis]
+    undetermined = out < 0
+    out[undetermined] = rng.integers(0, 2, size=int(undetermined.sum()))
+    return out
+
+def read_states(codes):
+    """
+    Batch counterpart of qubit.readState()
+    """
+    return READ_STATE[asarray(codes, dtype=uint8)]
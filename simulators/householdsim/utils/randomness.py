@@ -0,0 +1,24 @@
+"""
+Seeded random streams used by the QKD protocols.
+Each house and each protocol instance of the CC draws from its own numpy
+Generator, derived from the simulation seed and the entity name, so that a
+run is reproducible whatever the order in which entities are stepped.
+"""
+from zlib import crc32
+from numpy import uint8
+from numpy.random import Generator, PCG64, SeedSequence
+
+
+def stream(seed, *names):
+    """
+    Returns the Generator of the entity identified by names.
+    A seed of None gives a non reproducible stream.
+    """
+    key = [crc32(str(name).encode()) for name in names]
+    return Generator(PCG64(SeedSequence(seed, spawn_key=key)))
+
+def random_bits(rng, N):
+    """
+    Draws a vector of N random bits in a single call
+    """
+    return rng.integers(0, 2, size=N, dtype=uint8)
@@ -0,0 +1,81 @@
+"""
+Sizing of the QKD exchanges run by the crypto layers (OTP, AES) to fill
+their secret stack.
+"""
+from math import ceil, floor, sqrt
+
+PRIOR = 0.25   #key bits per qubit assumed before any round (lowest yield of the QKD protocols)
+
+
+class RoundSizing():
+    """
+    Tracks the key bits obtained per qubit sent (sifting yield minus the
+    verification loss) with an exponentially weighted moving average of the
+    successful QKD rounds, and uses it to size the next exchange.
+
+    @N : qubits of a regular round, also the smallest round
+    @overshoot : max ratio between the qubits of a round and the qubits
+    expected to give exactly the missing bits
+    @confidence : margin, in standard deviations of the binomial number of
+    key bits, kept above the missing bits
+    @alpha : weight of the last round in the moving average
+    """
+    def __init__(self, N, overshoot=2.0, confidence=3.0, alpha=0.2):
+        self.N = N
+        self.overshoot = overshoot
+        self.confidence = confidence
+        self.alpha = alpha
+        self.rate = None    #key bits per qubit, None until a round is observed
+        return
+
+    def observe(self, qubits, bits):
+        """
+        Updates the yield with a successful round of qubits giving bits key bits
+        """
+        if qubits <= 0:
+            return
+        rate = bits/qubits
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += self.alpha*(rate - self.rate)
+        return
+
+    def yield_rate(self):
+        """
+        Expected key bits per qubit
+        """
+        return max(self.rate if self.rate is not None else PRIOR, 1/self.N)
+
+    def qubits(self, missing):
+        """
+        Qubits of a single round giving at least missing key bits with high
+        probability, bounded by the overshoot and never less than N
+        """
+        if missing <= 0:
+            return self.N
+        p = self.yield_rate()
+        if p >= 1:
+            return max(self.N, missing)
+        #Smallest n with n*p - confidence*sqrt(n*p*(1-p)) >= missing,
+        #solved as a quadratic in sqrt(n)
+        s = self.confidence*sqrt(p*(1 - p))
+        root = (s + sqrt(s*s + 4*p*missing))/(2*p)
+        n = min(ceil(root*root), ceil(self.overshoot*missing/p))
+        return max(self.N, n)
+
+    def rounds(self, missing, max_rounds):
+        """
+        Regular rounds of N qubits giving no more than the missing key bits
+        with high probability, up to max_rounds. The rest is left to the next
+        exchange, so that merging does not run more rounds than one round per
+        exchange. A single round is run until the yield has been observed.
+        """
+        if missing <= 0 or self.rate is None:
+            return 1
+        p = self.yield_rate()
+        #Largest k with k*N*p + confidence*sqrt(k*N*p*(1-p)) <= missing,
+        #solved as a quadratic in sqrt(k)
+        s = self.confidence*sqrt(self.N*p*max(1 - p, 0))
+        root = (sqrt(s*s + 4*self.N*p*missing) - s)/(2*self.N*p)
+        return int(min(max_rounds, max(1, floor(root*root))))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The simulators import their helpers as the top level 'utils' package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'simulators', 'ControlCenter'))
@@ -0,0 +1,95 @@
+import json
+
+from numpy.random import default_rng
+
+from utils.bank import ProtocolBank, DONE
+from utils.OTP import Protocol
+
+
+def banks(n, options=None):
+    """Banks of n houses and of the CC ends of their links. The small
+    capacity makes the state mirrors grow"""
+    houses, cc = ProtocolBank(capacity=2), ProtocolBank(capacity=2)
+    for i in range(n):
+        houses.add(Protocol(16, 'node_%s' % i, False, 0, 'BB84', options, default_rng(i)), 'House_%s' % i)
+        cc.add(Protocol(16, 'CC', False, 0, 'BB84', options, default_rng(100 + i)), 'House_%s' % i)
+    return houses, cc
+
+
+def run(houses, cc, answers=None, steps=200):
+    """Steps the houses and the CC like the simulators do until both banks
+    are idle. Returns the answers of the CC not read by the houses yet"""
+    answers = answers or {}
+    for time in range(steps):
+        sent = {}
+        for i, out in enumerate(houses.step(answers, time)):
+            if out is not None and out != -1:
+                sent[i] = json.loads(json.dumps(out))
+        answers = {}
+        for i, ret in enumerate(cc.step(sent, time)):
+            if type(ret) is dict:
+                answers[i] = {'response': {'CC-0.CC': json.loads(json.dumps(ret))}}
+            elif ret == -1:
+                cc.add_message(i, 0.2)
+        if not answers and houses.idle() and cc.idle():
+            break
+    return answers
+
+
+def test_only_houses_with_something_to_do_are_stepped():
+    houses, cc = banks(5)
+    for i in range(5):
+        houses.add_message(i, 10.0 + i)
+    run(houses, cc)
+    assert (houses.states == DONE).all() and not houses.wake.any()
+    #nothing to do
+    outputs = houses.step({}, 0)
+    assert outputs == [None]*5 and houses.stepped.tolist() == []
+    #a queued message wakes its house only
+    houses.add_message(3, 1.5)
+    sent = houses.step({}, 1)
+    assert houses.stepped.tolist() == [3]
+    #an input wakes its house only
+    ret = cc.step({3: sent[3]}, 1)
+    assert cc.stepped.tolist() == [3]
+    #a house in an exchange is stepped until it is done, the other ones stay asleep
+    houses.step({}, 2)
+    assert houses.stepped.tolist() == [3]
+    houses.step({3: {'response': {'CC-0.CC': ret[3]}}}, 3)
+    assert houses.stepped.tolist() == [3]
+
+
+def test_pending_work_keeps_a_done_house_awake():
+    houses, cc = banks(3)
+    for i in range(3):
+        houses.add_message(i, 1.0)
+    houses.add_message(1, 2.0)
+    run(houses, cc)
+    #both messages went through: the house was woken up for the second one
+    assert houses.protocol(1).sD == [] and cc.protocol(1).outputs['n3'] == 0
+    assert (houses.states == DONE).all() and not houses.wake.any()
+
+
+def test_idle_honours_the_watermark():
+    houses, cc = banks(2)
+    for i in range(2):
+        houses.add_message(i, 3.0)
+    run(houses, cc)
+    assert houses.idle()
+    protocol = houses.protocol(0)
+    protocol.watermark = protocol.secret.level() + 1
+    assert not houses.idle()
+    protocol.watermark = protocol.secret.level()
+    assert houses.idle()
+
+
+def test_refills_run_until_the_watermark():
+    houses, cc = banks(3, {'key_watermark': 600})
+    for i in range(3):
+        houses.protocol(i).refill = True
+        houses.add_message(i, 3.0)
+    run(houses, cc, steps=2000)
+    assert houses.idle() and cc.idle()
+    for i in range(3):
+        assert houses.protocol(i).secret.level() >= 600
+        assert cc.protocol(i).secret.level() == houses.protocol(i).secret.level()
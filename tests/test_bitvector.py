@@ -0,0 +1,94 @@
+from numpy.random import default_rng
+
+from utils.bitvector import BitVector
+
+
+def random_bits(n, seed=0):
+    return default_rng(seed).integers(0, 2, size=n).tolist()
+
+
+def test_bits_round_trip():
+    bits = random_bits(29)
+    vector = BitVector(bits)
+    assert len(vector) == 29
+    assert vector.tolist() == bits
+    assert list(vector) == bits
+    assert vector == bits
+
+
+def test_tobytes_pads_last_byte():
+    assert BitVector([1, 0, 1]).tobytes() == b'\xa0'
+    assert BitVector([1]*9).tobytes() == b'\xff\x80'
+
+
+def test_from_bytes_keeps_length():
+    vector = BitVector.from_bytes(b'\xf0\xff', 12)
+    assert vector.tolist() == [1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 1]
+
+
+def test_hex():
+    assert BitVector([1, 0, 1, 1]).hex() == '0xb'
+
+
+def test_consume_aligned_and_unaligned():
+    bits = random_bits(50)
+    vector = BitVector(bits)
+    assert vector.consume(16).tolist() == bits[:16]   #byte aligned
+    assert vector.consume(3).tolist() == bits[16:19]
+    assert vector.consume(10).tolist() == bits[19:29]  #unaligned
+    assert vector.tolist() == bits[29:]
+
+
+def test_consume_more_than_available():
+    vector = BitVector([1, 0, 1])
+    assert vector.consume(8).tolist() == [1, 0, 1]
+    assert len(vector) == 0
+    assert vector.consume(4).tolist() == []
+
+
+def test_extend_after_consume():
+    bits = random_bits(300, 1)
+    vector = BitVector()
+    expected = []
+    for i in range(0, 300, 30):
+        vector.extend(bits[i:i + 30])
+        expected += bits[i:i + 30]
+        expected = expected[7:]
+        vector.consume(7)
+        assert vector.tolist() == expected
+
+
+def test_extend_with_bitvector():
+    vector = BitVector([1, 1, 0])
+    vector.extend(BitVector([0, 1]))
+    vector.extend([])
+    assert vector.tolist() == [1, 1, 0, 0, 1]
+
+
+def test_getitem():
+    vector = BitVector([0, 1, 1, 0])
+    assert vector[1] == 1
+    assert vector[1:3].tolist() == [1, 1]
+
+
+def test_xor_uses_first_bits_of_other():
+    a = BitVector([1, 0, 1, 0])
+    b = BitVector([1, 1, 0, 0, 1, 1])
+    assert (a ^ b).tolist() == [0, 1, 1, 0]
+
+
+def test_xor_unaligned():
+    bits = random_bits(40, 2)
+    other = random_bits(40, 3)
+    a = BitVector(bits)
+    a.consume(3)
+    b = BitVector(other)
+    assert (a ^ b).tolist() == [x ^ y for x, y in zip(bits[3:], other)]
+
+
+def test_encode_decode():
+    vector = BitVector(random_bits(21, 4))
+    message = vector.encode()
+    assert message['n'] == 21
+    assert BitVector.decode(message) == vector
+    assert BitVector.decode([1, 0, 1]).tolist() == [1, 0, 1]
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+pytest.importorskip('mosaik_api')
+
+from numpy.random import default_rng
+
+import CC
+from utils.bank import ProtocolBank
+from utils.OTP import Protocol
+
+
+class Mosaik():
+    """Records the data pushed by the CC"""
+    def __init__(self):
+        self.calls = []
+
+    def set_data(self, data):
+        self.calls.append(data)
+
+
+def step(cc, time, inputs):
+    """Runs a step of the CC, which yields its mosaik calls"""
+    steps = cc.step(time, inputs)
+    try:
+        while True:
+            next(steps)
+    except StopIteration as stop:
+        return stop.value
+
+
+def exchange(cc, houses, keys, time):
+    """Steps the houses and the CC like the simulators do until the
+    messages queued by the houses are received"""
+    answers = {}
+    for time in range(time, time + 200):
+        sent = {}
+        for i, out in enumerate(houses.step(answers, time)):
+            if out is not None and out != -1:
+                sent[keys[i]] = json.loads(json.dumps(out))
+        cc.mosaik.calls.clear()
+        step(cc, time, {'CC': {'ccresponse': sent}})
+        answers = {}
+        for call in cc.mosaik.calls:
+            for responses in call.values():
+                for key, data in responses.items():
+                    answers[keys.index(key)] = {'response': {'CC-0.CC': data['response']}}
+        if not answers and houses.idle() and cc.bank.idle():
+            return
+
+
+def test_get_data_serializes_only_the_changed_houses(monkeypatch):
+    cc = CC.CC()
+    cc.mosaik = Mosaik()
+    cc.init('CC-0', 1, 16, {'crypto': 'OTP', 'qkd': 'BB84'}, {'probability': 0}, options={'seed': 1})
+    keys = ['H-0.House_%s' % i for i in range(3)]
+    houses = ProtocolBank()
+    for i, key in enumerate(keys):
+        houses.add(Protocol(16, 'node_%s' % i, False, 0, 'BB84', None, default_rng(i)), key)
+        houses.add_message(i, 2.5)
+    exchange(cc, houses, keys, 0)
+    first = cc.get_data({'CC': ['ccresponse']})['CC']['ccresponse']
+    assert len(first) == 3 and not cc.dirty
+    dumped = []
+    dumps = json.dumps
+    monkeypatch.setattr(CC.json, 'dumps', lambda value: dumped.append(value) or dumps(value))
+    #nothing ran: nothing is serialized again
+    assert cc.get_data({'CC': ['ccresponse']})['CC']['ccresponse'] == first
+    assert dumped == []
+    #only the house sending a message is run and serialized again
+    houses.add_message(1, 7.5)
+    exchange(cc, houses, keys, 1000)
+    assert cc.dirty == {1}
+    dumped.clear()   #the messages of the exchange
+    response = cc.get_data({'CC': ['ccresponse']})['CC']['ccresponse']
+    assert dumped == [cc.bank.protocol(1).outputs]
+    assert response[0] == first[0] and response[2] == first[2] and response[1] != first[1]
+    assert not cc.dirty
@@ -0,0 +1,203 @@
+import importlib
+import json
+
+import pytest
+from numpy.random import default_rng
+
+from utils.communicationLayer import comLayer
+
+
+def link(crypto, qkd, options=None, N=64, eve=False, eveP=0):
+    """House and CC ends of a link, with the stored values received by the CC"""
+    module = importlib.import_module('utils.' + crypto)
+    house = module.Protocol(N, 'node', eve, eveP, qkd, options, default_rng(1))
+    cc = module.Protocol(N, 'CC', False, 0, qkd, options, default_rng(2))
+    return house, cc
+
+
+def send(house, cc, values, steps=400, late=0):
+    """Sends values from the house to the CC, stepping both ends like the
+    simulators do (the CC answers each received message). The CC sleeps
+    during the first late steps and reads the messages of the house when
+    it wakes up. Returns the values decoded by the CC and the number of
+    steps that carried data."""
+    received = []
+    decode = cc.__update_undetected_error__
+    cc.__update_undetected_error__ = lambda payload: received.append(decode(payload)) or received[-1]
+    layers = [comLayer(p, p.__get_states_mapping__()) for p in (house, cc)]
+    for value in values:
+        layers[0].__add_message_to_be_send__(value)
+    messages = 0
+    answer = None
+    sent = []   #messages of the house not read by the CC yet
+    for step in range(steps):
+        out = layers[0].__doStep__(answer)
+        answer = None
+        if out is not None and out != -1:
+            sent.append(out)
+        if step < late:
+            continue
+        #the values go through JSON like the mosaik messages
+        ret = layers[1].__doStep__(json.loads(json.dumps(sent.pop(0) if sent else None)))
+        if type(ret) is dict:
+            messages += 1
+            answer = {'response': {'CC-0.CC': json.loads(json.dumps(ret))}}
+        elif ret == -1:
+            layers[1].__add_message_to_be_send__(0.2)
+    return received, messages
+
+
+@pytest.mark.parametrize('crypto', ['OTP', 'AES'])
+@pytest.mark.parametrize('qkd', ['BB84', 'SARG04', 'KMB09'])
+def test_coalesced_rounds_deliver_the_same_values(crypto, qkd):
+    values = [12.5, 3000.25, 0.125]
+    plain, plain_messages = send(*link(crypto, qkd), values)
+    coalesced, coalesced_messages = send(*link(crypto, qkd, {'coalesce': True}), values)
+    assert plain == coalesced == values
+    assert coalesced_messages < plain_messages
+
+
+@pytest.mark.parametrize('crypto', ['OTP', 'AES'])
+def test_eve_in_merged_rounds(crypto):
+    house, cc = link(crypto, 'BB84', {'max_rounds': 8, 'payload_codec': 'fixed'}, eve=True, eveP=0.3)
+    values = [float(i) for i in range(6)]
+    received, _ = send(house, cc, values)
+    assert len(received) == len(values)
+    #detected rounds are counted, but the exchanges went through
+    assert house.outputs['n2'] > 0
+    assert cc.outputs['n2'] == house.outputs['n2']
+    #the values sent with a key changed by Eve are counted as undetected errors
+    assert cc.outputs['n3'] == sum(r != v for r, v in zip(received, values))
+
+
+def intercept_all(N, rounds):
+    """Runs Eve on every merged round of a house, returns the house protocol,
+    the common mask and the mask of the key bits changed by Eve"""
+    house, cc = link('OTP', 'BB84', N=N, eve=True, eveP=1)
+    p = house.protocol
+    p.rounds, p.qubits = rounds, rounds*N
+    p.__start_sender__(None)
+    #the receiver used the same basis: every photon is sifted, before Eve
+    common, changed = p.__intercept_rounds__(p.__compare_basis__({'response': p.senderData['basis'].encode()}))
+    return p, common, changed
+
+
+def test_intercepted_rounds_are_dropped_or_changed():
+    p, common, changed = intercept_all(8, 64)
+    bits = common.bits().reshape(64, 8)
+    kept = bits.all(axis=1)
+    #a round is dropped when detected, else it is kept with the key bits changed by Eve
+    assert (kept | ~bits.any(axis=1)).all()
+    assert p.lost == 64 - kept.sum()
+    assert len(changed) == 8*kept.sum() and changed.all()
+    #1 verification bit per round of 8 sifted bits: half of the rounds are not detected
+    assert 16 < kept.sum() < 48
+
+
+def test_all_rounds_intercepted_is_an_error():
+    #6 verification bits per round: every interception is detected
+    p, common, changed = intercept_all(64, 4)
+    assert p.lost == 4 and p.error
+    assert len(common) == 4*64 and not common.bits().any()
+    assert len(changed) == 0
+
+
+def test_aes_batch_uses_one_key_per_message():
+    house, cc = link('AES', 'BB84')
+    keys = []
+    encrypt = house.__Encryption__
+    house.__Encryption__ = lambda message, bits: keys.append(bits.tobytes()) or encrypt(message, bits)
+    values = [5.0, 5.0, 7.25]
+    received, _ = send(house, cc, values)
+    assert received == values
+    assert len(keys) == 3 and len(set(keys)) == 3
+    assert house.secret.level() == cc.secret.level()
+
+
+def test_aes_sessions_are_capped():
+    house, cc = link('AES', 'BB84', {'aes_session_messages': 2})
+    counts = []   #messages already sealed with the session, for each sealed message
+    for p in (house, cc):
+        p.__seal__ = (lambda seal: lambda message, session: counts.append(session["messages"]) or seal(message, session))(p.__seal__)
+    values = [float(i) for i in range(5)]
+    received, _ = send(house, cc, values)
+    assert received == values
+    assert len(counts) > 5 and max(counts) < 2
+    assert house.session["id"] == cc.session["id"] >= 2
+
+
+def test_aes_sessions_expire_with_time():
+    house, cc = link('AES', 'BB84', {'aes_session_seconds': 60})
+    ids = []
+    #both ends read the simulation time in seconds
+    for time in (0, 30, 59, 60, 61, 200):
+        house.time = cc.time = time
+        received, _ = send(house, cc, [float(time)])
+        assert received == [float(time)]
+        assert house.session["id"] == cc.session["id"]
+        ids.append(house.session["id"])
+    first = ids[0]
+    assert ids == [first, first, first, first + 1, first + 1, first + 2]
+
+
+@pytest.mark.parametrize('crypto', ['OTP', 'AES'])
+@pytest.mark.parametrize('qkd', ['BB84', 'SARG04', 'KMB09'])
+def test_late_responses_are_awaited(crypto, qkd):
+    values = [1.5, 2.5]
+    received, _ = send(*link(crypto, qkd), values, late=5)
+    assert received == values
+
+
+def spy_rounds(protocol):
+    """Records (top up target, qubits, rounds) of every round planned by protocol"""
+    planned = []
+    plan = protocol.__plan_round__
+    def spy():
+        plan()
+        planned.append((protocol.target, protocol.protocol.qubits, protocol.protocol.rounds))
+    protocol.__plan_round__ = spy
+    return planned
+
+
+@pytest.mark.parametrize('crypto', ['OTP', 'AES'])
+@pytest.mark.parametrize('options', [{'adaptive_sizing': True}, {'max_rounds': 8}])
+def test_refill_rounds_are_sized_from_the_watermark(crypto, options):
+    house, cc = link(crypto, 'BB84', dict(options, key_watermark=2000))
+    house.refill = True
+    planned = spy_rounds(house)
+    received, _ = send(house, cc, [1.5])
+    assert received == [1.5]
+    #the pools were topped up to the watermark, and stay in step
+    assert house.secret.level() >= 2000
+    assert cc.secret.level() == house.secret.level()
+    assert not house.__pending__()
+    refills = [(qubits, rounds) for target, qubits, rounds in planned if target]
+    assert refills
+    #the first top up round is sized for the whole deficit, not for N qubits
+    qubits, rounds = refills[0]
+    if 'adaptive_sizing' in options:
+        assert qubits > 2*house.N
+    else:
+        assert rounds > 1
+
+
+def eve_corruption(name):
+    """Values sent through Eve with the codec name, returns (wrong values, n3 of the CC)"""
+    house, cc = link('OTP', 'BB84', {'payload_codec': name}, eve=True, eveP=0.5)
+    values = [1000.0 + i/8 for i in range(40)]
+    received, _ = send(house, cc, values, steps=4000)
+    assert len(received) == len(values)
+    return sum(r != v for r, v in zip(received, values)), cc.outputs['n3']
+
+
+@pytest.mark.parametrize('name', ['fixed', 'float32', 'varint'])
+def test_eve_corruption_is_counted_by_binary_codecs(name):
+    wrong, n3 = eve_corruption(name)
+    assert wrong > 0
+    assert n3 == wrong
+
+
+def test_eve_corruption_text_codec():
+    #the text codec keeps the original wire format: a corrupted digit is still a number
+    wrong, n3 = eve_corruption('text')
+    assert 0 < n3 <= wrong
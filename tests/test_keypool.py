@@ -0,0 +1,58 @@
+from utils.bitvector import BitVector
+from utils.keypool import KeyPool
+
+
+def test_deposit_and_consume_in_order():
+    pool = KeyPool()
+    pool.deposit(BitVector([1, 0, 1]))
+    pool.deposit(BitVector([0, 0, 1, 1]))
+    assert pool.level() == len(pool) == 7
+    assert pool.consume(4).tolist() == [1, 0, 1, 0]
+    assert pool.consume(3).tolist() == [0, 1, 1]
+    assert pool.level() == 0
+
+
+def test_reserve_returns_whether_bits_are_there():
+    pool = KeyPool()
+    pool.deposit(BitVector([1]*10))
+    assert pool.reserve(8)
+    assert pool.available() == 2
+    assert not pool.reserve(8)   #16 bits reserved, 10 in the pool
+    assert pool.reserved == 16
+
+
+def test_consume_releases_reservation():
+    pool = KeyPool()
+    pool.reserve(6)
+    pool.deposit(BitVector([1]*8))
+    pool.consume(6)
+    assert pool.reserved == 0
+    assert pool.available() == 2
+    pool.consume(2)
+    assert pool.reserved == 0
+
+
+def test_capacity_drops_extra_bits():
+    pool = KeyPool(8)
+    assert pool.deposit(BitVector([1]*5)) == 5
+    assert pool.deposit(BitVector([0]*5)) == 3
+    assert pool.level() == 8
+    assert pool.dropped == 2
+    assert pool.is_full()
+    assert pool.consume(8).tolist() == [1]*5 + [0]*3
+
+
+def test_reservation_may_go_over_capacity():
+    pool = KeyPool(8)
+    pool.reserve(12)
+    assert pool.deposit(BitVector([1]*20)) == 12
+    assert pool.level() == 12
+    assert pool.is_full()
+    assert pool.dropped == 8
+
+
+def test_no_capacity():
+    pool = KeyPool()
+    pool.deposit(BitVector([1]*1000))
+    assert not pool.is_full()
+    assert pool.dropped == 0
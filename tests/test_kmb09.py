@@ -0,0 +1,43 @@
+from numpy.random import default_rng
+
+from utils.bitvector import BitVector
+from utils.KMB09 import Protocol
+
+
+def exchange(sender, receiver):
+    """Runs a QKD round between two protocols, the sender's inputs being
+    wrapped like the responses of the simulators"""
+    states = sender.__get_states_mapping__(), receiver.__get_states_mapping__()
+    message, sent = states[0][0](None)
+    received = 0
+    while not (sent in (3, 4) and received in (3, 4)):
+        message, received = states[1][received](message)
+        message, sent = states[0][sent]({'response': {'CC': message}} if message is not None else None)
+    return sent, received
+
+
+def test_compare_index():
+    p = Protocol(4, 'node')
+    mask = p.__compare_index__(BitVector([0, 1, 1, 0]), BitVector([0, 0, 1, 1]))
+    assert mask.tolist() == [0, 1, 0, 1]
+
+
+def test_create_key_is_the_opposite_of_the_basis():
+    p = Protocol(4, 'node')
+    key = p.__create_key__(BitVector([1, 0, 1, 0]), BitVector([1, 1, 0, 1]))
+    assert key.tolist() == [0, 1, 1]
+
+
+def test_create_shared_key():
+    p = Protocol(4, 'node')
+    key = p.__create_shared_key__(BitVector([1, 0, 1, 0]), BitVector([0, 1, 1, 0]))
+    assert key.tolist() == [0, 1]
+
+
+def test_both_ends_get_the_same_key():
+    for seed in range(5):
+        sender = Protocol(200, 'node', rng=default_rng(seed))
+        receiver = Protocol(200, 'CC', rng=default_rng(100 + seed))
+        assert exchange(sender, receiver) == (3, 3)
+        assert len(sender.key) > 0
+        assert sender.key == receiver.key
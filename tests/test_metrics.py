@@ -0,0 +1,68 @@
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+from utils.metrics import MetricsSink
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def outputs(n):
+    return {'n%s' % i: n*i for i in range(1, 9)}
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        MetricsSink('out', 0, 16, 0.2, 'csv')
+
+
+def test_json_records_of_several_intervals(tmp_path):
+    sink = MetricsSink(str(tmp_path / 'run'), 0, 16, 0.2, buffer=4)
+    for interval, time in enumerate((10800, 21600, 32400)):
+        for house in range(3):
+            sink.add('House_%s' % house, time, outputs(10*interval + house))
+    #the buffer is written every 4 records
+    assert len(read_lines(sink.path)) == 8
+    sink.close()
+    assert sink.handle is None
+    lines = read_lines(str(tmp_path / 'run.json'))
+    assert lines == [{'16-0.2': outputs(10*interval + house)} for interval in range(3) for house in range(3)]
+
+
+def test_json_appends_to_an_existing_output(tmp_path):
+    path = str(tmp_path / 'run')
+    for p in (0.2, 0.4):
+        sink = MetricsSink(path, 0, 16, p)
+        sink.add('House_0', 10800, outputs(1))
+        sink.close()
+    assert read_lines(path + '.json') == [{'16-0.2': outputs(1)}, {'16-0.4': outputs(1)}]
+
+
+def test_merge_cc_outputs(tmp_path, monkeypatch):
+    pytest.importorskip('mosaik')
+    monkeypatch.setattr(sys, 'argv', ['QKD-Sim.py'])
+    spec = importlib.util.spec_from_file_location('qkd_sim', os.path.join(ROOT, 'QKD-Sim.py'))
+    qkd_sim = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(qkd_sim)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(qkd_sim, 'SIMULATION_OUTPUT', True)
+    monkeypatch.setattr(qkd_sim, 'CC_SHARDS', 3)
+    monkeypatch.setattr(qkd_sim, 'START_REAL_TIME', 'run')
+    os.mkdir('output')
+    #each shard writes the records of its own houses
+    for shard in range(3):
+        sink = MetricsSink('output/run-CC-%s' % shard, 'run', 16, 0.2)
+        sink.add('House_%s' % shard, 10800, outputs(shard))
+        sink.close()
+    qkd_sim.merge_cc_outputs()
+    assert sorted(os.listdir('output')) == ['run-CC.json']
+    lines = read_lines('output/run-CC.json')
+    assert lines == [{'16-0.2': outputs(shard)} for shard in range(3)]
@@ -0,0 +1,131 @@
+import pytest
+
+from utils.payload import (TextCodec, FixedPointCodec, Float32Codec, VarintDeltaCodec, codec,
+                           seal, check, KEYFRAME, SCALE)
+
+VALUES = [0.0, 0.2, 1234.567, -42.125, 4999.999, 0.001]
+
+
+def test_codec_by_name():
+    assert isinstance(codec(), TextCodec)
+    assert isinstance(codec('text'), TextCodec)
+    assert isinstance(codec('fixed'), FixedPointCodec)
+    assert isinstance(codec('float32'), Float32Codec)
+    assert isinstance(codec('varint'), VarintDeltaCodec)
+    with pytest.raises(KeyError):
+        codec('zip')
+
+
+def test_stateful_codecs_are_new_instances():
+    assert codec('varint') is not codec('varint')
+
+
+def test_text_round_trip():
+    text = TextCodec()
+    assert text.encode(1234.5678) == b'1234.568'
+    for value in VALUES:
+        assert text.decode(text.encode(value)) == round(value, 3)
+
+
+def test_text_rejects_garbage():
+    with pytest.raises(ValueError):
+        TextCodec().decode(b'\x9a\x01')
+    with pytest.raises(ValueError):
+        TextCodec().decode(b'')
+
+
+def test_check_byte():
+    assert check(seal(b'\x01\x02')) == b'\x01\x02'
+    assert check(seal(b'')) == b''
+    for data in (b'', b'\x01\x02\x03', seal(b'\x01\x02')[::-1]):
+        with pytest.raises(ValueError):
+            check(data)
+
+
+@pytest.mark.parametrize('name', ['fixed', 'float32', 'varint'])
+def test_binary_codecs_reject_a_flipped_bit(name):
+    data = codec(name).encode(1234.5)
+    for i in range(8*len(data)):
+        bad = bytearray(data)
+        bad[i//8] ^= 1 << i % 8
+        with pytest.raises(ValueError):
+            codec(name).decode(bytes(bad))
+
+
+def test_fixed_round_trip():
+    fixed = FixedPointCodec()
+    for value in VALUES:
+        data = fixed.encode(value)
+        assert len(data) == 5
+        assert fixed.decode(data) == pytest.approx(value, abs=0.5/SCALE)
+
+
+def test_fixed_errors():
+    fixed = FixedPointCodec()
+    with pytest.raises(ValueError):
+        fixed.encode(2**31)
+    with pytest.raises(ValueError):
+        fixed.decode(b'\x00\x01')
+    with pytest.raises(ValueError):
+        fixed.decode(seal(b'\x00\x01'))
+
+
+def test_float32_round_trip():
+    f32 = Float32Codec()
+    for value in VALUES:
+        data = f32.encode(value)
+        assert len(data) == 5
+        assert f32.decode(data) == pytest.approx(value, rel=1e-6, abs=1e-6)
+
+
+def test_float32_errors():
+    f32 = Float32Codec()
+    with pytest.raises(ValueError):
+        f32.decode(b'')
+    with pytest.raises(ValueError):
+        f32.decode(seal(b'\x7f\x80\x00\x00'))   #infinity
+
+
+def test_varint_round_trip():
+    sender, receiver = VarintDeltaCodec(), VarintDeltaCodec()
+    for value in VALUES*5:
+        assert receiver.decode(sender.encode(value)) == round(value, 3)
+
+
+def test_varint_small_deltas_are_short():
+    sender = VarintDeltaCodec()
+    sender.encode(1000.0)
+    assert len(sender.encode(1000.05)) == 2
+    assert len(sender.encode(1000.0)) == 2
+
+
+def test_varint_keyframes():
+    sender = VarintDeltaCodec()
+    data = [sender.encode(100.0) for _ in range(KEYFRAME + 1)]
+    #the same value gives a zero delta, except for the keyframes
+    assert data[1] == seal(b'\x00')
+    assert data[0] == data[KEYFRAME] != seal(b'\x00')
+
+
+def test_varint_resyncs_after_a_corrupted_message():
+    sender, receiver = VarintDeltaCodec(), VarintDeltaCodec()
+    values = [10.0 + i for i in range(2*KEYFRAME)]
+    decoded = []
+    for i, value in enumerate(values):
+        data = sender.encode(value)
+        try:
+            decoded.append(receiver.decode(b'' if i == 3 else data))
+        except ValueError:
+            decoded.append(None)
+    assert decoded[:3] == values[:3]
+    #the later deltas are applied to a wrong value, so they are rejected up to the next keyframe
+    assert decoded[3:KEYFRAME] == [None]*(KEYFRAME - 3)
+    assert decoded[KEYFRAME:] == values[KEYFRAME:]
+
+
+def test_varint_malformed():
+    receiver = VarintDeltaCodec()
+    for data in (b'', seal(b''), seal(b'\x80'), seal(b'\x01\x02')):
+        with pytest.raises(ValueError):
+            receiver.decode(data)
+    assert receiver.received[1] == 4   #still counted
@@ -0,0 +1,72 @@
+from numpy import array, uint8, array_equal
+from numpy.random import default_rng
+
+from utils.qubit import (qubit, encode_photons, serialize_photons, pack_photons, unpack_photons,
+                         deserialize_photons, count_photons, measure_photons, read_states,
+                         STATE_0, STATE_1, STATE_PLUS, STATE_MINUS, STATE_UNKNOWN)
+
+
+def test_encode_photons_codes():
+    codes = encode_photons([0, 1, 0, 1], [0, 0, 1, 1])
+    assert codes.tolist() == [STATE_0, STATE_1, STATE_PLUS, STATE_MINUS]
+
+
+def test_serialize_photons_matches_qubit_serialize():
+    for data in (0, 1):
+        for basis in (0, 1):
+            q = qubit(data)
+            if basis:
+                q.hadamard()
+            assert serialize_photons(encode_photons([data], [basis])) == [q.serialize()]
+
+
+def test_deserialize_inverts_serialize():
+    codes = encode_photons([0, 1, 1, 0, 1], [1, 1, 0, 0, 1])
+    assert array_equal(deserialize_photons(serialize_photons(codes)), codes)
+
+
+def test_deserialize_unknown_state():
+    assert deserialize_photons([{'state': {'0': 0.5, '1': 0.5}}]).tolist() == [STATE_UNKNOWN]
+
+
+def test_pack_unpack_round_trip():
+    codes = default_rng(1).integers(0, 4, size=37, dtype=uint8)
+    packed = pack_photons(codes)
+    assert packed['n'] == 37
+    assert array_equal(unpack_photons(packed), codes)
+    assert array_equal(deserialize_photons(packed), codes)
+
+
+def test_pack_uses_two_bits_per_photon():
+    #4 photons fit in one byte: 0b00 01 10 11
+    assert pack_photons(array([0, 1, 2, 3], dtype=uint8))['photons'] == 'Gw=='
+    assert unpack_photons({'n': 4, 'photons': 'Gw=='}).tolist() == [0, 1, 2, 3]
+
+
+def test_pack_empty():
+    packed = pack_photons(array([], dtype=uint8))
+    assert packed['n'] == 0
+    assert len(unpack_photons(packed)) == 0
+
+
+def test_count_photons():
+    codes = encode_photons([0, 1, 1], [0, 1, 0])
+    assert count_photons(serialize_photons(codes)) == 3
+    assert count_photons(pack_photons(codes)) == 3
+
+
+def test_measure_same_basis_is_deterministic():
+    data = [0, 1, 0, 1]
+    basis = [0, 0, 1, 1]
+    out = measure_photons(encode_photons(data, basis), basis, default_rng(0))
+    assert out.tolist() == data
+
+
+def test_measure_other_basis_is_random():
+    codes = encode_photons([0]*1000, [0]*1000)
+    out = measure_photons(codes, [1]*1000, default_rng(0))
+    assert set(out.tolist()) == {0, 1}
+
+
+def test_read_states():
+    assert read_states([STATE_0, STATE_1, STATE_PLUS, STATE_MINUS, STATE_UNKNOWN]).tolist() == [0, 1, 0, 1, -1]
@@ -0,0 +1,47 @@
+from numpy import array_equal
+
+from utils.randomness import stream, random_bits
+from utils.bank import ProtocolBank
+from utils.OTP import Protocol
+
+ENTITIES = [('H-0.House_%s' % i,) for i in range(4)] + [('CC', 'H-0.House_%s' % i) for i in range(4)]
+
+
+def draws(order, seed=7):
+    """Builds the streams of the entities in the given order, and draws from
+    them in that order. Returns the draws of each entity"""
+    streams = {names: stream(seed, *names) for names in order}
+    out = {names: [] for names in order}
+    for _ in range(3):
+        for names in order:
+            out[names].append(random_bits(streams[names], 32))
+            out[names].append(streams[names].random())
+    return out
+
+
+def test_streams_do_not_depend_on_the_order():
+    first = draws(ENTITIES)
+    second = draws(ENTITIES[::-1])
+    for names in ENTITIES:
+        for a, b in zip(first[names], second[names]):
+            assert array_equal(a, b)
+
+
+def test_streams_differ_by_entity_and_seed():
+    bits = [random_bits(stream(7, *names), 64).tolist() for names in ENTITIES]
+    assert len(set(map(tuple, bits))) == len(ENTITIES)
+    assert random_bits(stream(8, 'CC'), 64).tolist() != random_bits(stream(7, 'CC'), 64).tolist()
+
+
+def test_houses_added_in_any_order_get_the_same_keys():
+    keys = []
+    for order in (range(4), reversed(range(4))):
+        bank = ProtocolBank()
+        for i in order:
+            bank.add(Protocol(32, 'node_%s' % i, False, 0, 'BB84', None, stream(7, 'H-0.House_%s' % i)), i)
+        protocols = {i: bank.protocol(bank.index(i)) for i in range(4)}
+        #the first QKD round of each house, as the sender
+        for i in range(4):
+            protocols[i].protocol.__start_sender__(None)
+        keys.append([protocols[i].protocol.senderData['data'].tolist() for i in range(4)])
+    assert keys[0] == keys[1]
@@ -0,0 +1,52 @@
+import pytest
+from numpy import array, uint8
+from numpy.random import default_rng
+
+from utils.qubit import deserialize_photons
+from utils.SARG04 import Protocol
+
+
+def exchange(sender, receiver):
+    """Runs a QKD round between two protocols, the sender's inputs being
+    wrapped like the responses of the simulators. Returns the final states
+    and the messages of the sender"""
+    states = sender.__get_states_mapping__(), receiver.__get_states_mapping__()
+    message, sent = states[0][0](None)
+    messages = [message]
+    received = 0
+    while not (sent in (3, 4) and received in (3, 4)):
+        message, received = states[1][received](message)
+        message, sent = states[0][sent]({'response': {'CC': message}} if message is not None else None)
+        messages.append(message)
+    return (sent, received), messages
+
+
+def test_list_of_possibilities_keeps_the_pairs():
+    p = Protocol(6, 'node', rng=default_rng(1))
+    first, second = array([0, 1, 2, 3, 0, 1], dtype=uint8), array([2, 3, 0, 1, 3, 2], dtype=uint8)
+    pairs = p.__list_of_possibilities__(first, second)
+    #each pair holds its two states, in a random order
+    assert [sorted(pair) for pair in pairs.tolist()] == [sorted(pair) for pair in zip(first.tolist(), second.tolist())]
+    assert (pairs[:, 0] != first).any()
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_both_ends_get_the_same_key(packed):
+    for seed in range(5):
+        sender = Protocol(200, 'node', options={'packed': packed}, rng=default_rng(seed))
+        receiver = Protocol(200, 'CC', options={'packed': packed}, rng=default_rng(100 + seed))
+        states, messages = exchange(sender, receiver)
+        assert states == (3, 3)
+        assert len(sender.key) > 0
+        assert sender.key == receiver.key
+
+
+def test_pairs_are_always_packed():
+    sender = Protocol(50, 'node', rng=default_rng(1))
+    receiver = Protocol(50, 'CC', rng=default_rng(2))
+    states, messages = exchange(sender, receiver)
+    #the photons keep the JSON wire format, the pairs are one packed batch
+    assert isinstance(messages[0], list)
+    pairs = messages[1]
+    assert isinstance(pairs, dict) and pairs['n'] == 100
+    assert len(deserialize_photons(pairs)) == 100
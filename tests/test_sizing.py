@@ -0,0 +1,65 @@
+import pytest
+
+from utils.sizing import RoundSizing, PRIOR
+
+
+def test_prior_before_any_round():
+    sizing = RoundSizing(100)
+    assert sizing.yield_rate() == PRIOR
+
+
+def test_yield_never_below_one_bit_per_round():
+    sizing = RoundSizing(10)
+    sizing.observe(10, 0)
+    assert sizing.yield_rate() == pytest.approx(0.1)
+
+
+def test_observe_moving_average():
+    sizing = RoundSizing(100, alpha=0.5)
+    sizing.observe(100, 40)
+    assert sizing.rate == pytest.approx(0.4)
+    sizing.observe(100, 20)
+    assert sizing.rate == pytest.approx(0.3)
+    sizing.observe(0, 0)   #ignored
+    assert sizing.rate == pytest.approx(0.3)
+
+
+def test_average_stays_within_observed_yields():
+    sizing = RoundSizing(100)
+    for bits in (10, 50, 30, 45, 12, 33):
+        sizing.observe(100, bits)
+        assert 0.10 <= sizing.rate <= 0.50
+
+
+def test_qubits_at_least_N():
+    sizing = RoundSizing(100)
+    assert sizing.qubits(0) == 100
+    assert sizing.qubits(-5) == 100
+    assert sizing.qubits(1) == 100
+
+
+def test_qubits_cover_missing_bits_within_overshoot():
+    sizing = RoundSizing(10, overshoot=2.0)
+    sizing.observe(100, 40)
+    n = sizing.qubits(1000)
+    assert 1000/0.4 < n <= 2.0*1000/0.4
+
+
+def test_qubits_full_yield():
+    sizing = RoundSizing(10)
+    sizing.observe(100, 100)
+    assert sizing.qubits(500) == 500
+
+
+def test_rounds_bounds():
+    sizing = RoundSizing(100)
+    #the yield is not known yet
+    assert sizing.rounds(10000, 8) == 1
+    sizing.observe(100, 25)
+    assert sizing.rounds(0, 8) == 1
+    assert sizing.rounds(10, 8) == 1
+    #the rounds stay below the missing bits with a margin
+    assert sizing.rounds(100, 8) == 3
+    assert sizing.rounds(200, 8) == 6
+    assert all(25*sizing.rounds(missing, 8) <= max(missing, 25) for missing in range(1000))
+    assert sizing.rounds(10000, 8) == 8